@@ -0,0 +1,307 @@
+"""
+Applies generated filters through the Gmail API: creates the filters that are
+missing from the account and retroactively labels the mail already received,
+using the sender of every message recorded in the email_fix.py cache.
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import logging
+from googleapiclient.errors import HttpError
+
+import email_fix
+import generate_filter_xmls
+import message_cache
+import sender_matcher
+
+FILTERS_FILE = "newMailFilters.xml"
+MODIFY_CHUNK = 1000  # Most message IDs users.messages.batchModify accepts
+
+# mailFilters.xml action properties -> (labels added, labels removed)
+ACTION_LABELS = {
+    "shouldArchive": ((), ("INBOX",)),
+    "shouldMarkAsRead": ((), ("UNREAD",)),
+    "shouldStar": (("STARRED",), ()),
+    "shouldTrash": (("TRASH",), ()),
+    "shouldNeverSpam": ((), ("SPAM",)),
+    "shouldAlwaysMarkAsImportant": (("IMPORTANT",), ()),
+    "shouldNeverMarkAsImportant": ((), ("IMPORTANT",)),
+}
+# mailFilters.xml criteria properties -> Gmail API criteria fields
+CRITERIA_FIELDS = {"from": "from", "to": "to", "subject": "subject",
+                   "hasTheWord": "query", "doesNotHaveTheWord": "negatedQuery"}
+
+
+def filter_action(properties, label_ids):
+  """Gmail API action for a filter's properties, as sorted label ID tuples."""
+  add, remove = set(), set()
+  for name, value in properties:
+    if name == "label" and value:
+      add.add(label_ids[value])
+    elif name in ACTION_LABELS and value == "true":
+      add.update(ACTION_LABELS[name][0])
+      remove.update(ACTION_LABELS[name][1])
+  return tuple(sorted(add)), tuple(sorted(remove))
+
+
+def filter_criteria(properties):
+  criteria = {}
+  for name, value in properties:
+    if name in CRITERIA_FIELDS and value:
+      criteria[CRITERIA_FIELDS[name]] = value
+    elif name == "hasAttachment" and value == "true":
+      criteria["hasAttachment"] = True
+  return criteria
+
+
+def get_label_ids(service, bucket=None):
+  """Map the account's label names to label IDs."""
+  existing = email_fix.execute_with_retry(
+      service.users().labels().list(userId="me"), bucket,
+      email_fix.QUOTA_COST["labels"], method="labels.list")
+  return {label["name"]: label["id"] for label in existing.get("labels", [])}
+
+
+def create_labels(service, names, bucket=None):
+  """Create the given labels and return {placeholder ID: real ID}."""
+  created_ids = {}
+  for name in sorted(names):
+    created = email_fix.execute_with_retry(
+        service.users().labels().create(
+            userId="me", body={"name": name, "labelListVisibility": "labelShow",
+                               "messageListVisibility": "show"}),
+        bucket, email_fix.QUOTA_COST["create_label"], method="labels.create")
+    created_ids[new_label_id(name)] = created["id"]
+    print(f'Created label "{name}".')
+  return created_ids
+
+
+def new_label_id(name):
+  """Stand-in ID for a label that is only created once the plan is confirmed."""
+  return f"<new label {name}>"
+
+
+def get_existing_filters(service, bucket=None):
+  """Index the account's filters by action and criteria.
+
+  Returns ({action: SenderMatcher}, set of (action, criteria) pairs).
+  """
+  results = email_fix.execute_with_retry(
+      service.users().settings().filters().list(userId="me"), bucket,
+      email_fix.QUOTA_COST["filters"], method="filters.list")
+  covered = {}
+  exact = set()
+  for gmail_filter in results.get("filter", []):
+    action = gmail_filter.get("action", {})
+    key = (tuple(sorted(action.get("addLabelIds", []))),
+           tuple(sorted(action.get("removeLabelIds", []))))
+    criteria = gmail_filter.get("criteria", {})
+    exact.add((key, tuple(sorted(criteria.items()))))
+    if set(criteria) == {"from"}:
+      matcher = covered.setdefault(key, sender_matcher.SenderMatcher())
+      for term in sender_matcher.split_criteria(criteria["from"]):
+        matcher.add(term)
+  return covered, exact
+
+
+def plan_filters(entries, label_ids, covered, exact):
+  """Work out which filters to create and which sender rules to backfill.
+
+  Returns (filter bodies to create, [(action, SenderMatcher)] for every
+  sender-only filter). Senders an existing filter with the same action
+  already covers are left out, and the rest are re-packed into as few
+  criteria as possible.
+  """
+  bodies = []
+  groups = {}
+  for entry in entries:
+    action = filter_action(entry["properties"], label_ids)
+    criteria = filter_criteria(entry["properties"])
+    if set(criteria) != {"from"}:
+      if criteria and (action, tuple(sorted(criteria.items()))) not in exact:
+        bodies.append({"criteria": criteria, "action": action})
+      continue
+    group = groups.setdefault(action, {"senders": [],
+                                       "matcher": sender_matcher.SenderMatcher()})
+    for sender in sender_matcher.split_criteria(criteria["from"]):
+      group["matcher"].add(sender)
+      if sender not in covered.get(action, ()):
+        group["senders"].append(sender)
+
+  for action, group in groups.items():
+    for packed in generate_filter_xmls.pack_criteria(group["senders"]):
+      bodies.append({"criteria": {"from": packed}, "action": action})
+
+  for body in bodies:
+    add, remove = body["action"]
+    body["action"] = {"addLabelIds": list(add), "removeLabelIds": list(remove)}
+  return bodies, [(action, group["matcher"]) for action, group in groups.items()]
+
+
+def create_filters(service, bodies, bucket=None):
+  """Create filters in batch requests of up to BATCH_SIZE calls.
+
+  Filters that fail transiently, alone or with the whole batch, are sent
+  again in a smaller batch after a backoff, as email_fix does for fetches.
+  """
+  outcome = {"created": 0, "failed": 0}
+  for start in range(0, len(bodies), email_fix.BATCH_SIZE):
+    chunk = [str(i) for i in range(start, min(start + email_fix.BATCH_SIZE,
+                                              len(bodies)))]
+    for attempt in itertools.count():
+      responses = {}
+      batch = service.new_batch_http_request(
+          callback=lambda request_id, *result:
+              responses.setdefault(request_id, result))
+      for request_id in chunk:
+        if bucket:
+          bucket.acquire(email_fix.QUOTA_COST["create_filter"])
+        batch.add(service.users().settings().filters().create(
+            userId="me", body=bodies[int(request_id)]), request_id=request_id)
+      batch_error = None
+      try:
+        batch.execute()
+      except (HttpError, OSError) as error:
+        batch_error = error
+
+      retry = []
+      retry_errors = []
+      for request_id in chunk:
+        _, error = responses.get(request_id, (None, batch_error))
+        if error is None:
+          outcome["created"] += 1
+        elif attempt < email_fix.MAX_RETRIES and email_fix.is_retryable(error):
+          retry.append(request_id)
+          retry_errors.append(error)
+        else:
+          outcome["failed"] += 1
+          logging.error("Could not create filter %s: %s", request_id, error)
+          print(f"Could not create filter {request_id}: {error}")
+      if not retry:
+        break
+      delay = email_fix.batch_retry_delay(attempt, retry_errors)
+      logging.warning("%i filters of a batch failed, retrying in %.1f seconds.",
+                      len(retry), delay)
+      time.sleep(delay)
+      chunk = retry
+  return outcome
+
+
+def collect_messages(cache, rules):
+  """Group cached message IDs by the action of every rule their sender
+  matches, without any API call.
+  """
+  targets = {}
+  for message_id, sender, _, _ in message_cache.iter_cached(cache):
+    if not sender:
+      continue
+    for action, matcher in rules:
+      if sender in matcher:
+        targets.setdefault(action, []).append(message_id)
+  return targets
+
+
+def relabel_messages(service, targets, bucket=None):
+  """Apply each action to its messages with batchModify, MODIFY_CHUNK IDs a call."""
+  calls = 0
+  for (add, remove), message_ids in targets.items():
+    for start in range(0, len(message_ids), MODIFY_CHUNK):
+      email_fix.execute_with_retry(
+          service.users().messages().batchModify(
+              userId="me", body={"ids": message_ids[start:start + MODIFY_CHUNK],
+                                 "addLabelIds": list(add),
+                                 "removeLabelIds": list(remove)}),
+          bucket, email_fix.QUOTA_COST["batch_modify"],
+          method="messages.batchModify")
+      calls += 1
+  return calls
+
+
+def apply_filters(service, filters_file, cache, create=True, relabel=True,
+                  dry_run=False, confirm=True, bucket=None):
+  """Plan, confirm and apply the filters; returns False if any filter could
+  not be created."""
+  entries = list(generate_filter_xmls.iter_filter_entries(filters_file))
+  labels = {value for entry in entries
+            for name, value in entry["properties"] if name == "label" and value}
+
+  label_ids = get_label_ids(service, bucket)
+  missing_labels = labels - label_ids.keys()
+  label_ids.update((name, new_label_id(name)) for name in missing_labels)
+  covered, exact = get_existing_filters(service, bucket)
+  bodies, rules = plan_filters(entries, label_ids, covered, exact)
+  targets = collect_messages(cache, rules) if relabel else {}
+
+  print(f"{len(missing_labels)} labels to create.")
+  print(f"{len(bodies)} filters to create.")
+  print(f"{sum(map(len, targets.values()))} existing emails to relabel in "
+        f"{sum(-(-len(ids) // MODIFY_CHUNK) for ids in targets.values())} calls.")
+  if dry_run:
+    return True
+  if confirm and input("Apply these changes to your mailbox? (y/n): ").strip().lower() != "y":
+    print("Nothing was changed.")
+    return True
+
+  created_ids = create_labels(service, missing_labels, bucket)
+  for body in bodies:
+    body["action"]["addLabelIds"] = [created_ids.get(label_id, label_id)
+                                     for label_id in body["action"]["addLabelIds"]]
+  targets = {(tuple(created_ids.get(label_id, label_id) for label_id in add), remove): ids
+             for (add, remove), ids in targets.items()}
+
+  outcome = {"failed": 0}
+  if create and bodies:
+    outcome = create_filters(service, bodies, bucket)
+    print(f"Created {outcome['created']} filters ({outcome['failed']} failed).")
+  if relabel and targets:
+    calls = relabel_messages(service, targets, bucket)
+    print(f"Relabelled existing emails with {calls} batchModify calls.")
+  return not outcome["failed"]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description="Create the generated filters in Gmail and apply them to "
+      "existing mail.")
+  parser.add_argument("--filters", default=FILTERS_FILE,
+                      help=f"filter file to apply (default {FILTERS_FILE})")
+  parser.add_argument("--no-create", action="store_true",
+                      help="do not create filters, only relabel existing mail")
+  parser.add_argument("--no-relabel", action="store_true",
+                      help="only create filters")
+  parser.add_argument("--dry-run", action="store_true",
+                      help="print what would change and exit")
+  parser.add_argument("--yes", action="store_true",
+                      help="do not ask for confirmation")
+  args = parser.parse_args(argv)
+
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  logging.basicConfig(filename="apply_filters.log", level=logging.INFO,
+                      format="%(asctime)s - %(levelname)s - %(message)s")
+  if not os.path.exists(args.filters):
+    print(f"File {args.filters} not found. Run generate_filter_xmls.py first.")
+    return 1
+
+  creds = email_fix.get_credentials()
+  if creds is None:
+    print("Failed to obtain credentials. Exiting.")
+    return 1
+  import gmail_transport
+  try:
+    service = gmail_transport.build_service(
+        gmail_transport.CredentialsManager(creds, email_fix.TOKEN_FILE))
+    applied = apply_filters(service, args.filters, message_cache.open_cache(),
+                            create=not args.no_create,
+                            relabel=not args.no_relabel, dry_run=args.dry_run,
+                            confirm=not args.yes, bucket=email_fix.TokenBucket())
+  except (HttpError, OSError) as error:
+    print(f"An error occurred while applying filters: {error}")
+    return 1
+  return 0 if applied else 1
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Benchmarks the pipeline stages, from the scan to applying the generated
+filters, against a synthetic mailbox and the in-process fake Gmail service,
+and appends the results to a JSON file so runs on different versions can be
+compared.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+from datetime import datetime
+
+import apply_filters
+import email_fix
+import fake_gmail
+import generate_filter_xmls
+import message_cache
+import scan_metrics
+import sender_index
+import tag_all_emails
+
+RESULTS_FILE = "benchmark_results.json"
+
+
+def timed(function, *args, **kwargs):
+  start = time.perf_counter()
+  result = function(*args, **kwargs)
+  return result, time.perf_counter() - start
+
+
+def bench_fetch(mailbox, args):
+  """Listing + process_messages in each fetch mode."""
+  results = {}
+  matcher = email_fix.parse_xml_file("mailFilters.xml")
+  modes = {
+      "sequential": {"batched": False, "workers": 1},
+      "batched": {"batched": True, "workers": 1},
+      "concurrent": {"batched": True, "workers": args.workers},
+      "sharded": {"batched": True, "workers": args.workers, "sharded": True},
+      "threads": {"batched": True, "workers": args.workers, "sharded": True,
+                  "threads": True},
+  }
+  for name, mode in modes.items():
+    service = fake_gmail.FakeGmailService(
+        mailbox, latency=args.latency, error_rate=args.error_rate)
+    metrics = scan_metrics.Metrics()
+    bucket = email_fix.TokenBucket(rate=args.quota, metrics=metrics) \
+        if args.quota else None
+    if mode.get("sharded"):
+      messages = email_fix.fetch_messages_sharded(service, len(mailbox), bucket,
+                                                  metrics, workers=args.workers)
+    else:
+      messages = email_fix.fetch_messages(service, len(mailbox), bucket, metrics)
+    _, seconds = timed(
+        email_fix.process_messages, service, messages,
+        matcher, batched=mode["batched"], workers=mode["workers"],
+        build_service=lambda: service, bucket=bucket, total=len(mailbox),
+        metrics=metrics, threads=mode.get("threads", False))
+    snapshot = metrics.snapshot()
+    results[name] = {"seconds": round(seconds, 4),
+                     "messages_per_second": round(len(mailbox) / seconds, 1),
+                     "api_calls": dict(service.calls),
+                     "stages": {stage: totals["seconds"] for stage, totals
+                                in snapshot["stages"].items() if totals["count"]},
+                     "counters": snapshot["counters"]}
+  return results
+
+
+def bench_tagger(args):
+  """Loading the tagger's input from the text report and from the index."""
+  open("xmlupdate.txt", "w", encoding="utf-8").close()
+  results = {}
+  _, seconds = timed(lambda: (
+      tag_all_emails.get_emails(email_fix.OUTPUT_FILE, "xmlupdate.txt",
+                                "mailFilters.xml"),
+      tag_all_emails.extract_subjects(email_fix.OUTPUT_FILE)))
+  results["text_report"] = {"seconds": round(seconds, 4),
+                            "bytes": os.path.getsize(email_fix.OUTPUT_FILE)}
+  senders, seconds = timed(lambda: sum(
+      1 for _ in tag_all_emails.iter_untagged_senders(
+          sender_index.INDEX_FILE, "xmlupdate.txt", "mailFilters.xml")))
+  results["sender_index"] = {"seconds": round(seconds, 4), "senders": senders,
+                             "bytes": os.path.getsize(sender_index.INDEX_FILE)}
+  return results
+
+
+def bench_generate(args):
+  """generate_filter_xmls.process_email_updates on a tagged index."""
+  labels = [f"Label {i}" for i in range(args.labels)]
+  with open("xmlupdate.txt", "w", encoding="utf-8") as f:
+    for i, record in enumerate(sender_index.iter_sender_index(sender_index.INDEX_FILE)):
+      f.write(f"{record['email']}: {labels[i % len(labels)]}\n")
+  _, seconds = timed(generate_filter_xmls.process_email_updates,
+                     "xmlupdate.txt", "mailFilters.xml", "newMailFilters.xml")
+  return {"seconds": round(seconds, 4),
+          "output_bytes": os.path.getsize("newMailFilters.xml")}
+
+
+def bench_apply(mailbox, args):
+  """apply_filters.apply_filters with the generated filters and a cache of
+  the whole mailbox, so every filter is created and its mail relabelled."""
+  cache = message_cache.open_cache(":memory:")
+  message_cache.store_messages(cache, [
+      (message["id"], email_fix.extract_email_address(message["from"]),
+       message["subject"], message["date"]) for message in mailbox])
+  service = fake_gmail.FakeGmailService(
+      mailbox, latency=args.latency, error_rate=args.error_rate)
+  bucket = email_fix.TokenBucket(rate=args.quota) if args.quota else None
+  _, seconds = timed(apply_filters.apply_filters, service, "newMailFilters.xml",
+                     cache, confirm=False, bucket=bucket)
+  cache.close()
+  return {"seconds": round(seconds, 4), "api_calls": dict(service.calls),
+          "filters_created": len(service.filters),
+          "messages_relabelled": len(service.message_labels)}
+
+
+def git_revision():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--messages", type=int, default=20000)
+  parser.add_argument("--senders", type=int, default=2000)
+  parser.add_argument("--filters", type=int, default=2000,
+                      help="entries in the synthetic mailFilters.xml")
+  parser.add_argument("--labels", type=int, default=20)
+  parser.add_argument("--latency", type=float, default=0.0,
+                      help="seconds per fake HTTP round trip")
+  parser.add_argument("--error-rate", type=float, default=0.0,
+                      help="probability of a 429 per API call")
+  parser.add_argument("--workers", type=int, default=email_fix.FETCH_WORKERS)
+  parser.add_argument("--quota", type=float, default=0,
+                      help="quota units per second (0 = unlimited)")
+  parser.add_argument("--output", default=RESULTS_FILE)
+  args = parser.parse_args()
+
+  output = os.path.abspath(args.output)
+  mailbox = fake_gmail.generate_mailbox(args.messages, args.senders)
+  run = {"timestamp": datetime.now().isoformat(), "revision": git_revision(),
+         "python": platform.python_version(), "parameters": vars(args).copy()}
+  run["parameters"].pop("output")
+
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as workdir:
+    os.chdir(workdir)
+    try:
+      fake_gmail.generate_filters_xml("mailFilters.xml", args.filters,
+                                      labels=args.labels)
+      print("Benchmarking fetch + process...")
+      run["fetch"] = bench_fetch(mailbox, args)
+      print("Benchmarking tagger loading...")
+      run["tagger"] = bench_tagger(args)
+      print("Benchmarking filter generation...")
+      run["generate"] = bench_generate(args)
+      print("Benchmarking applying filters...")
+      run["apply"] = bench_apply(mailbox, args)
+    finally:
+      os.chdir(cwd)
+
+  history = {"runs": []}
+  if os.path.exists(output):
+    with open(output, "r", encoding="utf-8") as f:
+      history = json.load(f)
+  history["runs"].append(run)
+  with open(output, "w", encoding="utf-8") as f:
+    json.dump(history, f, indent=2)
+
+  json.dump({key: run[key] for key in ("fetch", "tagger", "generate", "apply")},
+            sys.stdout, indent=2)
+  print(f"\nResults appended to {output}.")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,22 +1,59 @@
 import os
 import re
+import sys
+import math
+import json
+import argparse
 import pickle
 import time
+import random
 import logging
+import queue
+import itertools
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import xml.etree.ElementTree as ET
-from googleapiclient.discovery import build
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
 from googleapiclient.errors import HttpError
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import message_cache
+import message_ids as id_store
+import scan_metrics
+import sender_matcher
+import sender_sketch
+import sender_index
 
 # Configuration constants
 SCOPES = ["https://mail.google.com/"]
 TOKEN_FILE = "token.pickle"
 CREDENTIALS_FILE = "credentials.json"
-OUTPUT_FILE = "sorted_emails.txt"
+OUTPUT_FILE = "sorted_emails.txt"  # Human-readable view of the sender index
+INDEX_FILE = sender_index.INDEX_FILE
 XML_FILE = "mailFilters.xml"
+SYNC_STATE_FILE = "sync_state.json"  # historyId checkpoint of the last scan
+ACCOUNTS_DIR = "accounts"  # One subdirectory (token, cache, index) per account
 DEFAULT_COUNT = 80000  # Default number of emails to read
 COMMS_NUMBER = 50  # How many emails after which to give a status update
+BATCH_SIZE = 100  # Gmail allows at most 100 calls in one batch request
+LIST_PAGE_SIZE = 500  # Largest page messages.list will return
+LIST_WORKERS = 4  # Date shards listed at once (1 = a single page token chain)
+SHARD_SIZE = 2000  # Messages a date shard is sized to hold
+SHARD_MARGIN = 1.25  # Extra time the shards span, since mail density varies
+METADATA_HEADERS = ["From", "Subject", "Date"]  # Only headers needed for indexing
+USE_BATCH = True  # Fetch metadata through batch requests instead of one by one
+FETCH_THREADS = False  # Fetch whole threads instead of single messages
+PUSH_DOWN_FILTERS = True  # Let Gmail skip already filtered senders while listing
+FETCH_WORKERS = 4  # Number of concurrent fetch workers (1 = no worker pool)
+QUOTA_UNITS_PER_SECOND = 250  # Gmail per-user quota ceiling
+MAX_RETRIES = 5  # Retries of a transient failure before the message is dead-lettered
+BACKOFF_BASE = 1  # Seconds; the backoff cap doubles with every retry...
+BACKOFF_CAP = 32  # ...up to this many seconds
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}  # Sent with a 403
+DEAD_LETTER_FILE = "failed_messages.jsonl"  # Messages that failed every retry
+QUOTA_COST = {"list": 5, "get": 5, "thread": 10, "history": 2, "profile": 1,
+              "labels": 1, "create_label": 5, "filters": 1,
+              "create_filter": 5, "batch_modify": 50}  # Quota units per API method
 
 
 def extract_email_address(string):
@@ -24,21 +61,25 @@ def extract_email_address(string):
   return email_match.group(1) if email_match else string
 
 
-def get_credentials():
+def get_credentials(token_file=TOKEN_FILE, credentials_file=CREDENTIALS_FILE):
   creds = None
   try:
-    if os.path.exists(TOKEN_FILE):
-      with open(TOKEN_FILE, "rb") as token:
+    # Imported here so that importing this module stays cheap for offline use
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    import gmail_transport
+
+    if os.path.exists(token_file):
+      with open(token_file, "rb") as token:
         creds = pickle.load(token)
     if not creds or not creds.valid:
       if creds and creds.expired and creds.refresh_token:
         creds.refresh(Request())
       else:
         flow = InstalledAppFlow.from_client_secrets_file(
-            CREDENTIALS_FILE, SCOPES)
+            credentials_file, SCOPES)
         creds = flow.run_local_server(port=0)
-      with open(TOKEN_FILE, "wb") as token:
-        pickle.dump(creds, token)
+      gmail_transport.CredentialsManager(creds, token_file).save()
   except Exception as e:
     print(f"An error occurred while obtaining credentials: {e}")
     print("Please try the following steps to resolve the issue:")
@@ -48,203 +89,1295 @@ def get_credentials():
   return creds
 
 
-def fetch_messages(service, count):
+class TokenBucket:
+  """Thread-safe token bucket that paces API calls to the per-user quota.
+
+  Spent units and the time spent waiting for them are recorded in `metrics`
+  when one is given.
+  """
+
+  def __init__(self, rate=QUOTA_UNITS_PER_SECOND, capacity=None, metrics=None):
+    self.rate = rate
+    self.capacity = capacity or rate
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+    self.metrics = metrics
+
+  def acquire(self, units):
+    """Block until `units` quota units are available, then spend them."""
+    if self.metrics:
+      self.metrics.increment("quota_units", units)
+    units = min(units, self.capacity)
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= units:
+          self.tokens -= units
+          return
+        wait = (units - self.tokens) / self.rate
+      time.sleep(wait)
+      if self.metrics:
+        self.metrics.add_time("quota_wait", wait)
+
+
+def fetch_messages(service, count, bucket=None, metrics=None, query=None,
+                   page_token=None):
+  """Yield up to `count` message dicts ({"id", "threadId"}) page by page.
+
+  Pages are requested lazily, so fetching and aggregation can start on the
+  first page while the rest of the mailbox is still being listed. query is
+  a Gmail search (see list_query) that narrows what is listed, and
+  page_token continues a listing from a page already read.
+  """
   fetch_time = time.perf_counter()
-  messages = []
+  listed = 0
   try:
-    results = service.users().messages().list(
-        userId="me", maxResults=100).execute()
-    messages.extend(results.get("messages", []))
+    while listed < count:
+      results = execute_with_retry(
+          service.users().messages().list(
+              userId="me", maxResults=min(LIST_PAGE_SIZE, count - listed),
+              pageToken=page_token, q=query),
+          bucket, QUOTA_COST["list"], metrics, "list", "messages.list")
+      for message in results.get("messages", []):
+        yield message
+      listed += len(results.get("messages", []))
+      page_token = results.get("nextPageToken")
+      if not page_token:
+        break
+  except (HttpError, OSError) as error:
+    print(f"An error occurred while fetching messages: {error}")
 
-    while len(messages) < count and "nextPageToken" in results:
-      page_token = results["nextPageToken"]
-      results = service.users().messages().list(
-          userId="me", maxResults=100, pageToken=page_token).execute()
-      messages.extend(results["messages"])
+  logging.info("Successfully listed %i messages.", listed)
 
-    logging.info("Successfully fetched %i messages.", len(messages))
+  curr_time = round(time.perf_counter() - fetch_time, 2)
+  print(f"Listed {listed} messages. Time taken {curr_time} seconds.")
 
-    curr_time = round(time.perf_counter() - fetch_time, 2)
-    print(f"Time taken {curr_time} seconds.")
 
-    return messages[:count]
-  except HttpError as error:
+def get_internal_date(service, message_id, bucket=None, metrics=None):
+  """Seconds since the epoch at which Gmail received a message."""
+  message = execute_with_retry(
+      service.users().messages().get(userId="me", id=message_id, format="minimal"),
+      bucket, QUOTA_COST["get"], metrics, "list", "messages.get")
+  return int(message["internalDate"]) // 1000
+
+
+def plan_shards(newest, oldest, listed, wanted):
+  """Split the time before `oldest` into windows of about SHARD_SIZE messages.
+
+  The mail density comes from the `listed` messages received between newest
+  and oldest (epoch seconds), so it takes at least two to mean anything.
+  Returns (after, before) bounds, newest window first; neighbouring windows
+  overlap by a second so no message falls between them, and the last one
+  has no lower bound so it catches whatever the estimate missed. No window
+  is planned before the epoch, so a sparse first page or a count larger
+  than the mailbox yields fewer windows rather than negative dates.
+  """
+  density = max(listed - 1, 1) / max(newest - oldest, 1)
+  width = max(60, round(SHARD_SIZE / density))
+  shards = max(1, math.ceil(wanted * SHARD_MARGIN / SHARD_SIZE))
+  windows = []
+  for shard in range(shards):
+    before = oldest - shard * width + 1
+    if before <= 0:
+      break
+    after = oldest - (shard + 1) * width - 1
+    windows.append((after, before))
+    if after <= 0:
+      break
+  if not windows:
+    return [(None, max(oldest, 0) + 1)]
+  windows[-1] = (None, windows[-1][1])
+  return windows
+
+
+def fetch_messages_sharded(service, count, bucket=None, metrics=None,
+                           query=None, workers=LIST_WORKERS):
+  """Like fetch_messages, but lists date shards of the mailbox concurrently.
+
+  The first page is listed as usual, and the receive dates of its newest
+  and oldest message size the after:/before: windows the rest is split
+  into (see plan_shards). `workers` threads page through the windows, and
+  their pages are yielded in window order with every ID already yielded
+  dropped, so messages still come newest first and listing is no longer
+  one round trip after another. A window stops paging once it and the
+  newer windows together hold `count` messages. Pages waiting to be yielded
+  are kept as compact message_ids.MessageIdStore columns.
+  """
+  if workers <= 1:
+    yield from fetch_messages(service, count, bucket, metrics, query)
+    return
+
+  fetch_time = time.perf_counter()
+  yielded = 0
+  # IDs yielded so far, as integers, in case windows overlap more than planned
+  seen = set()
+  stop = threading.Event()
+  shards = []
+  try:
+    results = execute_with_retry(
+        service.users().messages().list(
+            userId="me", maxResults=min(LIST_PAGE_SIZE, count), q=query),
+        bucket, QUOTA_COST["list"], metrics, "list", "messages.list")
+    first_page = results.get("messages", [])
+    for message in first_page:
+      seen.add(int(message["id"], 16))
+      yielded += 1
+      yield message
+
+    if results.get("nextPageToken") and len(first_page) < 2:
+      # Too few receive dates to size windows with; page through the rest
+      for message in fetch_messages(service, count - yielded, bucket, metrics,
+                                    query, results["nextPageToken"]):
+        yielded += 1
+        yield message
+    elif results.get("nextPageToken") and len(first_page) < count:
+      newest = get_internal_date(service, first_page[0]["id"], bucket, metrics)
+      oldest = get_internal_date(service, first_page[-1]["id"], bucket, metrics)
+      limit = count - len(first_page)
+      shards = [(window, queue.Queue()) for window
+                in plan_shards(newest, oldest, len(first_page), limit)]
+      listed = [0] * len(shards)
+      resume_tokens = [None] * len(shards)  # Of windows that stopped early
+      work = queue.Queue()
+      for index in range(len(shards)):
+        work.put(index)
+
+      def list_shard(index, page_token=None, enough=limit):
+        (after, before), pages = shards[index]
+        terms = [query] if query else []
+        if after is not None:
+          terms.append(f"after:{after}")
+        terms.append(f"before:{before}")
+        try:
+          while not stop.is_set() and sum(listed[:index + 1]) < enough:
+            results = execute_with_retry(
+                service.users().messages().list(
+                    userId="me", maxResults=LIST_PAGE_SIZE,
+                    pageToken=page_token, q=" ".join(terms)),
+                bucket, QUOTA_COST["list"], metrics, "list", "messages.list")
+            page = results.get("messages", [])
+            pages.put(id_store.MessageIdStore.from_messages(page))
+            listed[index] += len(page)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+              break
+        except Exception as e:
+          pages.put(e)
+        finally:
+          resume_tokens[index] = page_token
+          pages.put(None)
+
+      def worker():
+        while not stop.is_set():
+          try:
+            list_shard(work.get_nowait())
+          except queue.Empty:
+            return
+
+      for _ in range(min(workers, len(shards))):
+        threading.Thread(target=worker, daemon=True).start()
+
+      for index, (_, pages) in enumerate(shards):
+        while True:
+          while yielded < count and (page := pages.get()) is not None:
+            if isinstance(page, Exception):
+              raise page
+            for message_id, thread_id in page.pairs():
+              if yielded >= count:
+                break
+              if message_id not in seen:
+                seen.add(message_id)
+                yielded += 1
+                yield page.message(message_id, thread_id)
+          if yielded >= count or not resume_tokens[index]:
+            break
+          # The window stopped counting IDs the overlaps repeat; list what
+          # is still missing here
+          list_shard(index, resume_tokens[index],
+                     sum(listed[:index + 1]) + count - yielded)
+        if yielded >= count:
+          break
+  except (HttpError, OSError) as error:
     print(f"An error occurred while fetching messages: {error}")
-    return messages
+  finally:
+    # Shards still listing stop after their current page
+    stop.set()
+
+  logging.info("Successfully listed %i messages in %i date shards.",
+               yielded, len(shards))
+
+  curr_time = round(time.perf_counter() - fetch_time, 2)
+  print(f"Listed {yielded} messages from {len(shards)} date shards. "
+        f"Time taken {curr_time} seconds.")
+
+
+def list_in_background(messages, listing_file, key, history_id=None):
+  """Drain a lister from a thread and yield its messages as they arrive.
+
+  The IDs collect in a message_ids.MessageIdStore, which is saved to
+  listing_file once listing is done, so a scan interrupted while fetching
+  can resume from it without listing again. Listing runs ahead of the
+  consumer but costs only 16 bytes a message.
+  """
+  store = id_store.MessageIdStore()
+  listed = threading.Condition()
+  state = {"done": False, "error": None}
+
+  def lister():
+    try:
+      for message in messages:
+        with listed:
+          store.append(message)
+          listed.notify()
+      store.save(listing_file, key, history_id)
+    except Exception as e:
+      logging.error("Listing stopped: %s", e)
+      state["error"] = e
+    finally:
+      with listed:
+        state["done"] = True
+        listed.notify()
+
+  threading.Thread(target=lister, daemon=True).start()
+  position = 0
+  while True:
+    with listed:
+      while position >= len(store) and not state["done"]:
+        listed.wait()
+      end = len(store)
+    if position >= end:
+      break
+    for index in range(position, end):
+      yield store[index]
+    position = end
+  if state["error"] is not None:
+    raise state["error"]
+
+
+def scope_query(after=None, before=None, labels=()):
+  """Gmail search terms limiting a scan to a date range and to any of labels.
+
+  after and before are dates; labels are label names as shown in Gmail.
+  """
+  terms = []
+  for operator, day in (("after", after), ("before", before)):
+    if day is not None:
+      midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+      terms.append(f"{operator}:{int(midnight.timestamp())}")
+  # Search writes spaces and nesting slashes in label names as hyphens
+  labels = ["label:" + re.sub(r"[\s/]+", "-", label.strip()).lower()
+            for label in labels]
+  if len(labels) > 1:
+    terms.append("{" + " ".join(labels) + "}")
+  else:
+    terms.extend(labels)
+  return " ".join(terms)
+
+
+def list_query(xml_emails, scope=""):
+  """The messages.list search of a full scan.
+
+  Adds `-from:(...)` groups for the senders existing filters already cover,
+  so Gmail leaves their mail out of the listing and it is never fetched.
+  Senders that do not fit in the query are still skipped client-side.
+  """
+  terms = [scope] if scope else []
+  if PUSH_DOWN_FILTERS and len(xml_emails):
+    exclusions, excluded = xml_emails.exclusion_query(
+        sender_matcher.MAX_QUERY_LENGTH - len(scope))
+    if exclusions:
+      terms.append(exclusions)
+    logging.info("Excluding %i of %i filtered senders in the search query.",
+                 excluded, len(xml_emails))
+    print(f"Excluding {excluded} of {len(xml_emails)} filtered senders "
+          "while listing.")
+  return " ".join(terms) or None
+
+
+def record_call(metrics, stage, method, call_time):
+  """Add an API round trip started at call_time to a stage and its histogram."""
+  elapsed = time.perf_counter() - call_time
+  metrics.add_time(stage, elapsed)
+  metrics.observe(method, elapsed)
+
+
+def is_retryable(error):
+  if isinstance(error, HttpError):
+    if error.resp.status == 403:
+      return any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+    return error.resp.status in RETRYABLE_STATUSES
+  return isinstance(error, OSError)  # Dropped connections and timeouts
+
+
+def get_retry_after(error):
+  resp = getattr(error, "resp", None)
+  return resp.get("retry-after") if resp is not None else None
+
+
+def retry_delay(attempt, error):
+  """Seconds to wait before retry number attempt + 1.
+
+  Honors a Retry-After header (in seconds or as an HTTP date), and otherwise
+  uses exponential backoff with full jitter so workers do not retry in step.
+  """
+  retry_after = get_retry_after(error)
+  if retry_after:
+    try:
+      return min(BACKOFF_CAP, max(0.0, float(retry_after)))
+    except ValueError:
+      try:
+        wait = parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+        return min(BACKOFF_CAP, max(0.0, wait.total_seconds()))
+      except (TypeError, ValueError):
+        pass
+  return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def batch_retry_delay(attempt, errors):
+  """One wait for a whole retry batch: the longest Retry-After, if any."""
+  return max((retry_delay(attempt, error) for error in errors
+              if get_retry_after(error)),
+             default=retry_delay(attempt, None))
+
+
+def note_failure(error, metrics=None):
+  if metrics and isinstance(error, HttpError) and error.resp.status == 429:
+    metrics.increment("rate_limited")
+
+
+def execute_with_retry(request, bucket=None, cost=0, metrics=None,
+                       stage="get", method="messages.get"):
+  """Execute a request, retrying transient failures with backoff."""
+  for attempt in itertools.count():
+    if bucket:
+      bucket.acquire(cost)
+    call_time = time.perf_counter()
+    try:
+      response = request.execute()
+    except (HttpError, OSError) as error:
+      # Recorded before the backoff, which is not round-trip time
+      if metrics:
+        record_call(metrics, stage, method, call_time)
+      note_failure(error, metrics)
+      if attempt >= MAX_RETRIES or not is_retryable(error):
+        raise
+      delay = retry_delay(attempt, error)
+      logging.warning("%s failed (%s), retrying in %.1f seconds.",
+                      method, error, delay)
+      if metrics:
+        metrics.increment("retries")
+      time.sleep(delay)
+      continue
+    if metrics:
+      record_call(metrics, stage, method, call_time)
+    return response
+
+
+def chunked(iterable, size):
+  """Yield lists of up to `size` items from any iterable."""
+  iterator = iter(iterable)
+  while chunk := list(itertools.islice(iterator, size)):
+    yield chunk
+
+
+def get_history_id(service, bucket=None):
+  profile = execute_with_retry(service.users().getProfile(userId="me"), bucket,
+                               QUOTA_COST["profile"], method="getProfile")
+  return profile["historyId"]
+
+
+def fetch_history_messages(service, start_history_id, bucket=None):
+  """List messages added since start_history_id.
+
+  Returns (messages, history_id), or None when Gmail no longer has history
+  that old and a full scan is required. Transient failures are retried; any
+  other error is raised.
+  """
+  messages = {}
+  history_id = start_history_id
+  page_token = None
+  try:
+    while True:
+      results = execute_with_retry(
+          service.users().history().list(
+              userId="me", startHistoryId=start_history_id,
+              historyTypes=["messageAdded"], pageToken=page_token),
+          bucket, QUOTA_COST["history"], method="history.list")
+      for record in results.get("history", []):
+        for added in record.get("messagesAdded", []):
+          message = added["message"]
+          messages[message["id"]] = {"id": message["id"],
+                                     "threadId": message.get("threadId")}
+      history_id = results.get("historyId", history_id)
+      page_token = results.get("nextPageToken")
+      if not page_token:
+        break
+  except HttpError as error:
+    if error.resp.status == 404:
+      logging.warning("History %s expired, falling back to a full scan.",
+                      start_history_id)
+      return None
+    raise
+
+  logging.info("Found %i messages added since history %s.",
+               len(messages), start_history_id)
+  return list(messages.values()), history_id
+
+
+def load_sync_state(state_file=SYNC_STATE_FILE):
+  try:
+    with open(state_file, "r", encoding="utf-8") as f:
+      return json.load(f)
+  except (FileNotFoundError, json.JSONDecodeError):
+    return {}
+
+
+def save_sync_state(history_id, state_file=SYNC_STATE_FILE):
+  with open(state_file, "w", encoding="utf-8") as f:
+    json.dump({"historyId": history_id}, f)
+
+
+def load_output(output_file=OUTPUT_FILE, index_file=INDEX_FILE):
+  """Read the counts and subject samples of a previous run.
+
+  Uses the sender index when there is one, and otherwise parses the text
+  report.
+  """
+  if os.path.exists(index_file):
+    return sender_index.load_sender_index(index_file)
+
+  unique_emails = {}
+  email_subjects = {}
+  try:
+    with open(output_file, "r", encoding="utf-8") as f:
+      lines = f.readlines()
+  except FileNotFoundError:
+    return unique_emails, email_subjects
+
+  try:
+    start_index = lines.index("BY FREQUENCY\n") + 1
+  except ValueError:
+    return unique_emails, email_subjects
+
+  for line in lines[start_index:]:
+    if " || " not in line:
+      continue
+    email, count, subjects = line.rstrip("\n").split(" || ", 2)
+    unique_emails[email] = int(count)
+    email_subjects[email] = subjects.removeprefix("Subjects: ").split(" | ")
+  return unique_emails, email_subjects
 
 
 def parse_xml_file(xml_file):
+  """Return a SenderMatcher for every sender covered by an existing filter."""
   try:
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-
-    xml_emails = set()
-    for prop in root.findall('.//apps:property[@name="from "]', namespaces={"apps": "http://schemas.google.com/apps/2006"}):
-      value = prop.get("value")
-      if value is not None:
-        emails = value.split(" OR ")
-        xml_emails.update(extract_email_address(
-            email.strip()) for email in emails)
-    return xml_emails
+    return sender_matcher.load_filter_matcher(xml_file)
   except ET.ParseError as e:
     print(f"Error parsing XML file: {e}")
-    return set()
   except FileNotFoundError:
     print(f"XML file {xml_file} not found.")
-    return set()
   except Exception as e:
     print(f"An unexpected error occurred while parsing the XML file: {e}")
-    return set()
+  return sender_matcher.SenderMatcher()
+
+
+def parse_headers(headers):
+  email = None
+  subject = "No Subject"  # Default value if no subject found
+  date = None
+  for values in headers:
+    if values["name"] == "From":
+      email = extract_email_address(values["value"])
+    elif values["name"] == "Subject":
+      # Replace line breaks with spaces, remove leading/trailing whitespace
+      subject = values["value"].replace(
+          '\r\n', ' ').replace('\n', ' ').strip()
+    elif values["name"] == "Date":
+      date = values["value"]
+  return email, subject, date
+
+
+def get_message_request(service, message_id):
+  return service.users().messages().get(
+      userId="me", id=message_id, format="metadata",
+      metadataHeaders=METADATA_HEADERS)
+
+
+def get_thread_request(service, thread_id):
+  return service.users().threads().get(
+      userId="me", id=thread_id, format="metadata",
+      metadataHeaders=METADATA_HEADERS)
+
+
+def fetch_target(threads):
+  """(request builder, quota cost, method name) of a message or thread fetch."""
+  if threads:
+    return get_thread_request, QUOTA_COST["thread"], "threads.get"
+  return get_message_request, QUOTA_COST["get"], "messages.get"
+
 
+def fetch_metadata_sequential(service, message_ids, on_result, bucket=None,
+                              metrics=None, threads=False):
+  """Fetch message metadata one blocking request at a time.
 
-def process_messages(service, messages, xml_emails):
+  With threads set, the IDs are thread IDs and whole threads are fetched.
+  """
+  get_request, cost, method = fetch_target(threads)
+  for message_id in message_ids:
+    try:
+      msg = execute_with_retry(get_request(service, message_id), bucket, cost,
+                               metrics, "get", method)
+    except (HttpError, OSError) as error:
+      on_result(message_id, None, error)
+    else:
+      on_result(message_id, msg, None)
+
+
+def fetch_metadata_batched(service, message_ids, on_result, bucket=None,
+                           metrics=None, threads=False):
+  """Fetch message metadata in Gmail batch requests of up to BATCH_SIZE calls.
+
+  on_result(message_id, response, exception) is called once per message,
+  after the batch's round trip so its time is not counted as fetch time.
+  Messages that fail transiently, alone or with the whole batch, are sent
+  again in a smaller batch after a backoff. With threads set, the IDs are
+  thread IDs and whole threads are fetched.
+  """
+  get_request, cost, _ = fetch_target(threads)
+  for start in range(0, len(message_ids), BATCH_SIZE):
+    chunk = message_ids[start:start + BATCH_SIZE]
+    for attempt in itertools.count():
+      responses = {}
+      batch = service.new_batch_http_request(
+          callback=lambda message_id, *result: responses.setdefault(message_id, result))
+      for message_id in chunk:
+        if bucket:
+          bucket.acquire(cost)
+        batch.add(get_request(service, message_id), request_id=message_id)
+      call_time = time.perf_counter()
+      batch_error = None
+      try:
+        batch.execute()
+      except (HttpError, OSError) as error:
+        batch_error = error
+      if metrics:
+        record_call(metrics, "get", "batch", call_time)
+
+      retry = []
+      retry_errors = []
+      for message_id in chunk:
+        msg, error = responses.get(message_id, (None, batch_error))
+        if error is not None:
+          note_failure(error, metrics)
+        if error is not None and attempt < MAX_RETRIES and is_retryable(error):
+          retry.append(message_id)
+          retry_errors.append(error)
+        else:
+          on_result(message_id, msg, error)
+      if not retry:
+        break
+      delay = batch_retry_delay(attempt, retry_errors)
+      logging.warning("%i messages of a batch failed, retrying in %.1f seconds.",
+                      len(retry), delay)
+      if metrics:
+        metrics.increment("retries", len(retry))
+      time.sleep(delay)
+      chunk = retry
+
+
+def fetch_metadata_concurrent(build_service, chunks, on_result,
+                              workers=FETCH_WORKERS, bucket=None,
+                              batched=USE_BATCH, metrics=None, threads=False):
+  """Fetch message metadata from a pool of worker threads.
+
+  `chunks` is an iterable of message ID lists, consumed lazily so it can be
+  fed straight from the lister. Every worker gets its service from
+  build_service, which must either build a new one per call or return one
+  on a thread-safe transport, and takes chunks off a bounded queue.
+  Results are funnelled through a queue to the calling thread, which is the
+  only one that invokes on_result, so aggregation needs no locking.
+  """
+  work = queue.Queue(maxsize=max(1, workers) * 2)
+  results = queue.Queue()
+  fetch = fetch_metadata_batched if batched else fetch_metadata_sequential
+
+  def worker():
+    try:
+      service = build_service()
+      while (chunk := work.get()) is not None:
+        try:
+          fetch(service, chunk, lambda *result: results.put(result), bucket,
+                metrics, threads)
+        except Exception as e:
+          for message_id in chunk:
+            results.put((message_id, None, e))
+    except Exception as e:
+      logging.error("Fetch worker stopped: %s", e)
+    finally:
+      results.put(None)  # Tell the consumer this worker is done
+
+  pool = [threading.Thread(target=worker, daemon=True)
+          for _ in range(max(1, workers))]
+  for thread in pool:
+    thread.start()
+  running = len(pool)
+
+  def drain(block):
+    nonlocal running
+    while running:
+      try:
+        result = results.get(block=block, timeout=0.1 if block else None)
+      except queue.Empty:
+        return
+      if result is None:
+        running -= 1
+      else:
+        on_result(*result)
+      block = False
+
+  for chunk in chunks:
+    while True:
+      if not running:
+        error = RuntimeError("All fetch workers stopped")
+        for message_id in chunk:
+          on_result(message_id, None, error)
+        break
+      try:
+        work.put(chunk, timeout=0.1)
+        break
+      except queue.Full:
+        drain(block=False)
+    drain(block=False)
+
+  # Workers still busy with a full queue only take a sentinel once they are
+  # done, so keep draining until every running worker has one
+  stop_signals = 0
+  while running and stop_signals < len(pool):
+    try:
+      work.put(None, timeout=0.1)
+      stop_signals += 1
+    except queue.Full:
+      drain(block=False)
+  while running:
+    drain(block=True)
+
+  # Chunks queued after the last worker died were never fetched
+  while True:
+    try:
+      chunk = work.get_nowait()
+    except queue.Empty:
+      break
+    for message_id in chunk or []:
+      on_result(message_id, None, RuntimeError("All fetch workers stopped"))
+
+
+def process_messages(service, messages, xml_emails, batched=USE_BATCH,
+                     workers=FETCH_WORKERS, build_service=None, bucket=None,
+                     merge_with=None, cache=None, total=None, metrics=None,
+                     sketch=None, dead_letter_file=DEAD_LETTER_FILE,
+                     threads=FETCH_THREADS):
+  """Fetch, aggregate and write out the senders of `messages`.
+
+  `messages` may be any iterable of message dicts, including the lazy
+  fetch_messages generator; total is the expected count used for the ETA.
+
+  merge_with is an optional (unique_emails, email_subjects) pair from an
+  earlier run that the new counts are added onto. cache is an open
+  message_cache connection: messages already in it are aggregated without
+  any API call, and every newly fetched message is written to it so an
+  interrupted scan resumes where it stopped. Stage times, API latencies and
+  error counts are recorded in `metrics`. With a sender_sketch.SenderSketch
+  as `sketch`, senders are aggregated in fixed memory and only its tracked
+  heavy hitters, with approximate counts, are written out. Messages that
+  still fail after retries are appended to dead_letter_file.
+
+  With threads set, each message's thread is fetched with one threads.get
+  instead, and the thread's other listed messages are answered from it
+  without a call of their own; messages of the thread that are not listed
+  are not counted. A thread costs two messages' quota, so this pays off
+  once threads average more than two listed messages. Returns the
+  aggregated pair, or None if processing failed.
+  """
   unique_emails = {}
   email_subjects = {}
-  total_messages = len(messages)
-  start_time = time.perf_counter()
-  next_milestone = COMMS_NUMBER
-  last_email_process_time = start_time  # Initialize the last email process time
+  if merge_with is not None:
+    for email, count in merge_with[0].items():
+      if email not in xml_emails:
+        if sketch is not None:
+          sketch.add(email, count=count)
+          for subject in list(merge_with[1].get(email, []))[:2]:
+            sketch.add_subject(email, subject)
+        else:
+          unique_emails[email] = count
+          email_subjects[email] = list(merge_with[1].get(email, []))[:2]
+  metrics = metrics or scan_metrics.Metrics()
+  metrics.total = total
+  progress = {"processed": 0, "cached": 0, "failed": 0,
+              "next_milestone": COMMS_NUMBER}
+  pending = []  # Fetched rows not yet committed to the cache
+  # Thread mode: headers of fetched threads' messages not listed yet, the
+  # listed messages waiting on each thread in flight, the threads already
+  # fetched, and listed messages their thread turned out not to contain
+  thread_headers = {}
+  waiting = {}
+  fetched_threads = set()
+  leftovers = []
+
+  def store_pending():
+    with metrics.timer("write"):
+      message_cache.store_messages(cache, pending)
+    pending.clear()
+
+  def dead_letter(message_id, error):
+    """Persist a message that failed for good so it can be replayed."""
+    metrics.increment("errors")
+    progress["failed"] += 1
+    with open(dead_letter_file, "a", encoding="utf-8") as f:
+      f.write(json.dumps({"id": message_id, "error": str(error)}) + "\n")
 
   try:
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-      if not messages:
-        f.write("All Mails is Empty\n")
+    def record(email, subject):
+      if email is not None and email not in xml_emails:
+        if sketch is not None:
+          sketch.add(email, subject)
+          return
+        unique_emails[email] = unique_emails.get(email, 0) + 1
+        if email in email_subjects:
+          if len(email_subjects[email]) < 2:
+            email_subjects[email].append(subject)
+        else:
+          email_subjects[email] = [subject]
+
+    def report_progress(messages_done):
+      progress["processed"] += messages_done
+      metrics.progress(messages_done)
+      i = progress["processed"]
+      if i < progress["next_milestone"]:
+        return
+      progress["next_milestone"] = i - i % COMMS_NUMBER + COMMS_NUMBER
+      eta = metrics.eta()
+      if eta is None:
+        print(f"Processed {i} messages.")
+        logging.info("Processed %i messages.", i)
       else:
-        for i, message_tuple in enumerate(messages):
-          current_time = time.perf_counter()  # Get current time for this iteration
+        print(f"Processed {i}/{total} messages. ETA: {eta // 60:.0f} minutes "
+              f"{int(eta % 60)} seconds.")
+        logging.info("Processed %i/%i messages. ETA: %.0f minutes %.0f seconds.",
+                     i, total, eta // 60, eta % 60)
 
-          try:
-            message = dict(message_tuple)
-            msg = service.users().messages().get(
-                userId="me", id=message["id"]).execute()
-            email_data = msg["payload"]["headers"]
-            email_processed = False  # Flag to track if email has been processed
-            subject = "No Subject"  # Default value if no subject found
-
-            for values in email_data:
-              if values["name"] == "From":
-                email = extract_email_address(values["value"])
-                if email not in xml_emails:
-                  unique_emails[email] = unique_emails.get(email, 0) + 1
-                  email_processed = True  # Mark email as processed
-                  last_email_process_time = current_time  # Update last process time
-
-              elif values["name"] == "Subject":
-                  # Replace line breaks with spaces
-                subject = values["value"].replace(
-                    '\n', ' ').replace('\r\n', ' ')
-                # Remove any leading/trailing whitespace
-                subject = subject.strip()
-
-            if email_processed:
-              if email in email_subjects:
-                if len(email_subjects[email]) < 2:
-                  email_subjects[email].append(subject)
-              else:
-                email_subjects[email] = [subject]
-
-            if not email_processed:
-              # Check if 10 seconds have passed since the last successful email processing
-              if current_time - last_email_process_time > 10:
-                logging.warning(
-                    "API LIMIT REACHED, PLEASE WAIT")
-                print("API LIMIT REACHED, PLEASE WAIT")
-
-          except HttpError as error:
-            logging.error(
-                "An error occurred with message ID %s: %s",
-                message["id"], error
-            )
-            f.write(
-                f"An error occurred with message ID {message['id']}: {error}\n")
-          except Exception as e:
-            logging.error(
-                "An unexpected error occurred with message ID %s: %s",
-                message["id"], e)
-            f.write(
-                f"An unexpected error occurred with message ID {
-                    message['id']}: {e}\n"
-            )
-
-          if i >= next_milestone:
-            elapsed_time = current_time - start_time
-            estimated_total_time = (
-                elapsed_time / (i + 1)) * total_messages
-            eta = estimated_total_time - elapsed_time
-            print(
-                f"Processed {
-                    i}/{total_messages} messages. ETA: {eta // 60:.0f} minutes {int(eta % 60)} seconds."
-            )
-
-            logging.info(
-                "Processed {}/{} messages. ETA: {:.0f} minutes {:.0f} seconds.".format(
-                    i, total_messages, eta // 60, eta % 60
-                )
-            )
-
-            next_milestone += COMMS_NUMBER
-
-        unique_emails_alphabetical = sorted(unique_emails.items())
-        unique_emails_count = sorted(
-            unique_emails.items(), key=lambda item: item[1], reverse=True)
-
-        f.write("-----------------------------\n")
-        f.write("BY ALPHABETICAL\n")
-        for email, count in unique_emails_alphabetical:
-          subjects = " | ".join(
-              email_subjects.get(email, ["No Subject"]))
-          f.write(f"{email} || {count} || Subjects: {subjects}\n")
-
-        f.write("-----------------------------\n")
-        f.write("BY FREQUENCY\n")
-        for email, count in unique_emails_count:
-          subjects = " | ".join(
-              email_subjects.get(email, ["No Subject"]))
-          f.write(f"{email} || {count} || Subjects: {subjects}\n")
-
-        f.write("-----------------------------\n")
+    def store(message_id, email, subject, date):
+      if cache is not None:
+        pending.append((message_id, email, subject, date))
+        if len(pending) >= BATCH_SIZE:
+          store_pending()
+      with metrics.timer("aggregate"):
+        record(email, subject)
 
+    def on_result(message_id, msg, error):
+      if isinstance(error, HttpError):
+        logging.error(
+            "An error occurred with message ID %s: %s", message_id, error)
+        dead_letter(message_id, error)
+      elif error is not None:
+        logging.error(
+            "An unexpected error occurred with message ID %s: %s",
+            message_id, error)
+        dead_letter(message_id, error)
+      else:
+        try:
+          with metrics.timer("parse"):
+            headers = parse_headers(msg["payload"]["headers"])
+          store(message_id, *headers)
+        except Exception as e:
+          logging.error(
+              "An unexpected error occurred with message ID %s: %s",
+              message_id, e)
+          dead_letter(message_id, e)
+      report_progress(1)
+
+    def on_thread_result(thread_id, thread, error):
+      message_ids = waiting.pop(thread_id)
+      fetched_threads.add(thread_id)
+      if error is not None:
+        for message_id in message_ids:
+          on_result(message_id, None, error)
+        return
+      try:
+        with metrics.timer("parse"):
+          for msg in thread.get("messages", []):
+            thread_headers[msg["id"]] = parse_headers(msg["payload"]["headers"])
+      except Exception as e:
+        for message_id in message_ids:
+          on_result(message_id, None, e)
+        return
+      for message_id in message_ids:
+        if message_id in thread_headers:
+          store(message_id, *thread_headers.pop(message_id))
+          report_progress(1)
+        else:
+          leftovers.append(message_id)
+
+    def thread_chunks(chunks):
+      """Turn chunks of listed messages into chunks of threads to fetch."""
+      for chunk in chunks:
+        thread_ids = []
+        for message in chunk:
+          message_id = message["id"]
+          thread_id = message.get("threadId")
+          if message_id in thread_headers:
+            store(message_id, *thread_headers.pop(message_id))
+            report_progress(1)
+          elif thread_id is None or thread_id in fetched_threads:
+            leftovers.append(message_id)
+          elif thread_id in waiting:
+            waiting[thread_id].append(message_id)
+          else:
+            waiting[thread_id] = [message_id]
+            thread_ids.append(thread_id)
+        if thread_ids:
+          yield thread_ids
+
+    def uncached_chunks():
+      """Split the message stream into chunks, answering cached IDs locally."""
+      for chunk in chunked(messages, BATCH_SIZE):
+        if cache is not None:
+          cached = message_cache.get_cached(
+              cache, [message["id"] for message in chunk])
+          with metrics.timer("aggregate"):
+            for sender, subject, _ in cached.values():
+              record(sender, subject)
+          progress["cached"] += len(cached)
+          metrics.increment("cached", len(cached))
+          report_progress(len(cached))
+          chunk = [message for message in chunk if message["id"] not in cached]
+        if chunk:
+          yield chunk
+
+    if threads:
+      chunks, handler = thread_chunks(uncached_chunks()), on_thread_result
+    else:
+      chunks = ([message["id"] for message in chunk]
+                for chunk in uncached_chunks())
+      handler = on_result
+    fetch = fetch_metadata_batched if batched else fetch_metadata_sequential
+    if workers > 1 and build_service is not None:
+      fetch_metadata_concurrent(build_service, chunks, handler, workers,
+                                bucket, batched, metrics, threads)
+    else:
+      for ids in chunks:
+        fetch(service, ids, handler, bucket, metrics, threads)
+    if leftovers:
+      # Listed after their thread was fetched, or without a threadId
+      for message_ids in chunked(leftovers, BATCH_SIZE):
+        fetch(service or build_service(), message_ids, on_result, bucket,
+              metrics)
+
+    if progress["cached"]:
+      print(f"{progress['cached']} emails were answered from the cache.")
+
+    if sketch is not None:
+      unique_emails, email_subjects = sketch.top()
+      print(f"Kept the top {len(unique_emails)} senders; counts may be "
+            f"overestimated by up to {sketch.error_bound():.1f}.")
+
+    if progress["failed"]:
+      print(f"{progress['failed']} emails could not be fetched and were saved "
+            f"to {dead_letter_file}. Run with --replay-failed to retry them.")
+
+    with metrics.timer("write"):
+      with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        if not progress["processed"] and not unique_emails:
+          f.write("All Mails is Empty\n")
+        else:
+          sender_index.write_text_report(f, unique_emails, email_subjects)
+      sender_index.write_sender_index(INDEX_FILE, unique_emails,
+                                      email_subjects)
+
+    print(metrics.summary())
+    return unique_emails, email_subjects
   except Exception as e:
-    logging.error("An unexpected error occurred with message ID %s: %s",
-                  message["id"], e)
+    logging.error("An unexpected error occurred while processing messages: %s", e)
     print(f"An error occurred while processing messages: {e}")
+    return None
+  finally:
+    # Keep whatever was fetched before an error or Ctrl-C for the next run
+    if cache is not None and pending:
+      store_pending()
+    metrics.export()
 
 
-def main():
-  os.chdir(os.path.dirname(os.path.abspath(__file__)))
-  logging.basicConfig(filename="email_processing.log", level=logging.INFO,
-                      format="%(asctime)s - %(levelname)s - %(message)s")
-  logging.info("Script execution started.")
-
+def ask_count():
   user_input = input(
       f"How many emails would you like to read? (default {DEFAULT_COUNT}): ")
 
   try:
-    count_mess = int(user_input) if user_input else DEFAULT_COUNT
+    return int(user_input) if user_input else DEFAULT_COUNT
   except ValueError:
     print("Invalid input. Using the default value.")
-    count_mess = DEFAULT_COUNT
-  print(f"Fetching {count_mess} emails...")
+    return DEFAULT_COUNT
 
-  creds = get_credentials()
-  if creds is None:
-    print("Failed to obtain credentials. Exiting.")
-    return
 
+def has_previous_scan(directory="."):
+  state = load_sync_state(os.path.join(directory, SYNC_STATE_FILE))
+  return bool(state.get("historyId")) and (
+      os.path.exists(os.path.join(directory, INDEX_FILE))
+      or os.path.exists(os.path.join(directory, OUTPUT_FILE)))
+
+
+def new_sketch(sketch_params):
+  return sender_sketch.SenderSketch(**sketch_params) if sketch_params else None
+
+
+def scan_mailbox(creds, count, incremental, xml_emails=None, metrics=None,
+                 sketch_params=None, scope="", threads=FETCH_THREADS):
+  """Scan the mailbox creds belong to into the files of the current directory.
+
+  With incremental set, only mail added since the saved historyId is
+  fetched; count is the number of emails a full scan reads, and is asked for
+  when a full scan turns out to be needed and count is None. xml_emails is
+  the SenderMatcher of already filtered senders, read from XML_FILE if not
+  given. sketch_params switches to bounded-memory aggregation (see
+  sender_sketch.SenderSketch). scope holds search terms (see scope_query)
+  limiting a full scan, whose count then only covers matching emails.
+  threads fetches whole threads (see process_messages). Returns the
+  (unique_emails, email_subjects) written to the index, or None if the scan
+  failed.
+  """
+  import gmail_transport
+
+  # One service on a pooled keep-alive transport, shared by all fetch and
+  # listing workers
+  credentials_manager = gmail_transport.CredentialsManager(creds, TOKEN_FILE)
   try:
-    service = build("gmail", "v1", credentials=creds)
+    service = gmail_transport.build_service(
+        credentials_manager, pool_size=FETCH_WORKERS + LIST_WORKERS)
   except Exception as e:
     print(f"An error occurred while building the Gmail service: {e}")
-    return
+    return None
+
+  if xml_emails is None:
+    xml_emails = parse_xml_file(XML_FILE)
+  bucket = TokenBucket(metrics=metrics)
+  history = None
+  if incremental:
+    try:
+      history = fetch_history_messages(service, load_sync_state()["historyId"],
+                                       bucket)
+    except (HttpError, OSError) as e:
+      logging.error("Could not read the mailbox history: %s", e)
+      print(f"An error occurred while reading the mailbox history: {e}")
+      return None
+    if history is None:
+      print("The previous scan is too old to sync incrementally. Running a full scan.")
+      count = count or ask_count()
+
+  if history is not None:
+    messages, history_id = history
+    merge_with = load_output(OUTPUT_FILE, INDEX_FILE)
+    print(f"{len(messages)} new emails since the last scan.")
+  else:
+    query = list_query(xml_emails, scope)
+    key = id_store.scan_key(query, count)
+    listing = id_store.MessageIdStore.load(id_store.LISTED_IDS_FILE, key)
+    if listing is not None and listing.history_id:
+      print(f"Resuming the interrupted scan of {len(listing)} listed emails.")
+      history_id = listing.history_id
+      messages = iter(listing)
+    else:
+      # Taken before listing, so mail arriving mid-scan is caught by the next sync
+      try:
+        history_id = get_history_id(service, bucket)
+      except (HttpError, OSError) as e:
+        logging.error("Could not read the mailbox profile: %s", e)
+        print(f"An error occurred while reading the mailbox profile: {e}")
+        return None
+      messages = list_in_background(
+          fetch_messages_sharded(service, count, bucket, metrics, query),
+          id_store.LISTED_IDS_FILE, key, history_id)
+    merge_with = None
+
+  print("Beginning processing task")
+  result = process_messages(service, messages, xml_emails,
+                            build_service=lambda: service, bucket=bucket,
+                            merge_with=merge_with,
+                            cache=message_cache.open_cache(),
+                            total=count if history is None else len(messages),
+                            metrics=metrics, sketch=new_sketch(sketch_params),
+                            threads=threads)
+  if result is not None:
+    save_sync_state(history_id)
+    if history is None:
+      if listing is not None:
+        listing.close()
+      if os.path.exists(id_store.LISTED_IDS_FILE):
+        os.remove(id_store.LISTED_IDS_FILE)
+  return result
+
+
+def load_failed(dead_letter_file=DEAD_LETTER_FILE):
+  """Return the distinct message IDs in a dead-letter file, oldest first."""
+  message_ids = {}
+  try:
+    with open(dead_letter_file, "r", encoding="utf-8") as f:
+      for line in f:
+        if line.strip():
+          message_ids[json.loads(line)["id"]] = None
+  except FileNotFoundError:
+    pass
+  return list(message_ids)
+
+
+def replay_failed(creds, cache, metrics=None, sketch_params=None,
+                  dead_letter_file=DEAD_LETTER_FILE):
+  """Refetch the dead-lettered messages and merge them into the index.
+
+  The file is set aside while replaying, so messages that fail again start
+  a fresh dead-letter file; it is only deleted once the replay succeeded.
+  Returns whether it did.
+  """
+  import gmail_transport
+
+  replaying_file = dead_letter_file + ".replaying"
+  if os.path.exists(dead_letter_file):
+    with open(dead_letter_file, "r", encoding="utf-8") as src, \
+         open(replaying_file, "a", encoding="utf-8") as dst:
+      dst.write(src.read())
+    os.remove(dead_letter_file)
+  # Messages a later scan fetched are already counted in the index
+  failed = load_failed(replaying_file)
+  cached = message_cache.get_cached(cache, failed)
+  message_ids = [message_id for message_id in failed if message_id not in cached]
+  if not message_ids:
+    print("There are no failed emails to replay.")
+    if os.path.exists(replaying_file):
+      os.remove(replaying_file)
+    return True
+
+  print(f"Replaying {len(message_ids)} failed emails...")
+  service = gmail_transport.build_service(
+      gmail_transport.CredentialsManager(creds, TOKEN_FILE),
+      pool_size=FETCH_WORKERS + 1)
+  result = process_messages(service, ({"id": message_id} for message_id in message_ids),
+                            parse_xml_file(XML_FILE),
+                            build_service=lambda: service,
+                            bucket=TokenBucket(metrics=metrics),
+                            merge_with=load_output(OUTPUT_FILE, INDEX_FILE),
+                            cache=cache, total=len(message_ids), metrics=metrics,
+                            sketch=new_sketch(sketch_params),
+                            dead_letter_file=dead_letter_file)
+  if result is None:
+    return False
+  os.remove(replaying_file)
+  return True
+
+
+def scan_account(account_dir, count, incremental, xml_file, metrics_file,
+                 metrics_format, sketch_params=None, scope="",
+                 threads=FETCH_THREADS):
+  """Process pool entry point: scan one account inside its own directory."""
+  os.chdir(account_dir)
+  logging.basicConfig(filename="email_processing.log", level=logging.INFO,
+                      format="%(asctime)s - %(levelname)s - %(message)s",
+                      force=True)
+  creds = get_credentials()
+  if creds is None:
+    return False
+  return scan_mailbox(creds, count, incremental, parse_xml_file(xml_file),
+                      scan_metrics.Metrics(metrics_file, metrics_format),
+                      sketch_params, scope, threads) is not None
+
+
+def scan_accounts(accounts, metrics_file, metrics_format, sketch_params=None,
+                  count=None, full=False, scope="", threads=FETCH_THREADS):
+  """Scan several accounts in parallel, one process each, and merge their
+  indexes into the combined sorted_emails.txt and sender index.
+
+  Without a count, asks how many emails to read and whether to sync
+  incrementally. Returns whether every account was scanned.
+  """
+  account_dirs = {account: os.path.abspath(os.path.join(ACCOUNTS_DIR, account))
+                  for account in accounts}
+  # Sign in first, one account at a time, so browser prompts never overlap
+  for account, account_dir in account_dirs.items():
+    os.makedirs(account_dir, exist_ok=True)
+    print(f"Signing in to account {account}...")
+    if get_credentials(os.path.join(account_dir, TOKEN_FILE)) is None:
+      print(f"Failed to obtain credentials for account {account}. Exiting.")
+      return False
+
+  incremental = not full
+  if count is None:
+    if not full and any(has_previous_scan(account_dir)
+                        for account_dir in account_dirs.values()):
+      answer = input("Only fetch emails received since the last scan, for the "
+                     "accounts that have one? (Y/n): ")
+      incremental = answer.strip().lower() != "n"
+    count = ask_count()
+
+  print(f"Scanning {len(accounts)} accounts in parallel...")
+  scanned = True
+  with ProcessPoolExecutor(max_workers=len(accounts)) as pool:
+    futures = {account: pool.submit(
+        scan_account, account_dir, count,
+        incremental and has_previous_scan(account_dir),
+        os.path.abspath(XML_FILE), metrics_file, metrics_format, sketch_params,
+        scope, threads)
+        for account, account_dir in account_dirs.items()}
+    for account, future in futures.items():
+      try:
+        if not future.result():
+          scanned = False
+          print(f"Scanning account {account} failed.")
+      except Exception as e:
+        scanned = False
+        logging.error("Scanning account %s failed: %s", account, e)
+        print(f"Scanning account {account} failed: {e}")
+
+  index_files = {account: os.path.join(account_dir, INDEX_FILE)
+                 for account, account_dir in account_dirs.items()
+                 if os.path.exists(os.path.join(account_dir, INDEX_FILE))}
+  unique_emails, email_subjects, account_counts = \
+      sender_index.merge_sender_indexes(index_files)
+  with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+    sender_index.write_text_report(f, unique_emails, email_subjects,
+                                   account_counts)
+  sender_index.write_sender_index(INDEX_FILE, unique_emails, email_subjects,
+                                  account_counts)
+  print(f"Merged {len(index_files)} account indexes: "
+        f"{sum(unique_emails.values())} emails from {len(unique_emails)} senders.")
+  return scanned
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Index the senders of your emails.")
+  parser.add_argument("--count", type=int,
+                      help="number of emails a full scan reads; runs without "
+                      "any prompt, syncing incrementally when possible")
+  parser.add_argument("--full", action="store_true",
+                      help="always run a full scan instead of an incremental sync")
+  parser.add_argument("--offline", action="store_true",
+                      help="rebuild the index from the message cache without "
+                      "calling the Gmail API")
+  parser.add_argument("--replay-failed", action="store_true",
+                      help=f"only refetch the emails saved to {DEAD_LETTER_FILE} "
+                      "by earlier scans and merge them into the index")
+  parser.add_argument("--accounts", nargs="*", metavar="NAME",
+                      help=f"scan several accounts in parallel, each with its "
+                      f"own token under {ACCOUNTS_DIR}/NAME (all of them if no "
+                      f"name is given), and merge their indexes")
+  parser.add_argument("--after", type=date.fromisoformat, metavar="YYYY-MM-DD",
+                      help="only scan emails received after this day; implies --full")
+  parser.add_argument("--before", type=date.fromisoformat, metavar="YYYY-MM-DD",
+                      help="only scan emails received before this day; implies --full")
+  parser.add_argument("--label", action="append", default=[], metavar="NAME",
+                      help="only scan emails with this label (repeat for any "
+                      "of several); implies --full")
+  parser.add_argument("--threads", action="store_true",
+                      help="fetch each thread once instead of every message; "
+                      "fewer calls when threads are long")
+  parser.add_argument("--metrics", choices=["jsonl", "prometheus", "off"],
+                      default="jsonl",
+                      help="export scan metrics as JSON lines (default) or a "
+                      "Prometheus text file")
+  parser.add_argument("--metrics-file",
+                      help=f"where to export metrics (default "
+                      f"{scan_metrics.METRICS_FILE} or {scan_metrics.PROMETHEUS_FILE})")
+  parser.add_argument("--bounded", type=int, nargs="?", metavar="SENDERS",
+                      const=sender_sketch.TRACKED_SENDERS,
+                      help="aggregate in fixed memory, keeping only the top "
+                      f"SENDERS senders (default {sender_sketch.TRACKED_SENDERS}) "
+                      "with approximate counts")
+  parser.add_argument("--epsilon", type=float, default=sender_sketch.SKETCH_EPSILON,
+                      help="with --bounded, Count-Min error as a fraction of "
+                      "all messages")
+  parser.add_argument("--delta", type=float, default=sender_sketch.SKETCH_DELTA,
+                      help="with --bounded, probability of exceeding that error")
+  args = parser.parse_args(argv)
+  if args.offline and args.accounts is not None:
+    parser.error("--offline re-indexes a single account's cache")
+  if args.replay_failed and (args.offline or args.accounts is not None):
+    parser.error("--replay-failed replays a single account's failed emails")
+  scope = scope_query(args.after, args.before, args.label)
+  if scope and (args.offline or args.replay_failed):
+    parser.error("--after, --before and --label limit what a scan lists")
+  # Gmail history cannot be scoped, so a scoped scan is always a full one
+  args.full = args.full or bool(scope)
+
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  logging.basicConfig(filename="email_processing.log", level=logging.INFO,
+                      format="%(asctime)s - %(levelname)s - %(message)s")
+  logging.info("Script execution started.")
+
+  metrics_file = None
+  if args.metrics != "off":
+    metrics_file = args.metrics_file or (
+        scan_metrics.PROMETHEUS_FILE if args.metrics == "prometheus"
+        else scan_metrics.METRICS_FILE)
+  sketch_params = None
+  if args.bounded:
+    sketch_params = {"capacity": args.bounded, "epsilon": args.epsilon,
+                     "delta": args.delta}
+
+  if args.accounts is not None:
+    accounts = args.accounts
+    if not accounts and os.path.isdir(ACCOUNTS_DIR):
+      accounts = sorted(entry.name for entry in os.scandir(ACCOUNTS_DIR)
+                        if entry.is_dir())
+    if not accounts:
+      print(f"No accounts found in {ACCOUNTS_DIR}/. Name the accounts to scan.")
+      return 1
+    scanned = scan_accounts(accounts, metrics_file, args.metrics, sketch_params,
+                            args.count, args.full, scope, args.threads)
+    return 0 if scanned else 1
+
+  metrics = scan_metrics.Metrics(metrics_file, args.metrics)
+  if args.offline:
+    cache = message_cache.open_cache()
+    total = message_cache.count_cached(cache)
+    print(f"Re-indexing {total} cached emails...")
+    messages = ({"id": row[0]} for row in message_cache.iter_cached(cache))
+    result = process_messages(None, messages, parse_xml_file(XML_FILE),
+                              cache=cache, total=total, metrics=metrics,
+                              sketch=new_sketch(sketch_params))
+    return 0 if result is not None else 1
+
+  if args.replay_failed:
+    creds = get_credentials()
+    if creds is None:
+      print("Failed to obtain credentials. Exiting.")
+      return 1
+    replayed = replay_failed(creds, message_cache.open_cache(), metrics,
+                             sketch_params)
+    return 0 if replayed else 1
+
+  incremental = False
+  count_mess = args.count
+  if has_previous_scan() and not args.full:
+    if count_mess is not None:
+      incremental = True
+    else:
+      answer = input(
+          "A previous scan was found. Only fetch emails received since then? (Y/n): ")
+      incremental = answer.strip().lower() != "n"
+
+  if not incremental:
+    count_mess = count_mess or ask_count()
+    print(f"Fetching {count_mess} emails...")
+
+  creds = get_credentials()
+  if creds is None:
+    print("Failed to obtain credentials. Exiting.")
+    return 1
 
-  messages = fetch_messages(service, count_mess)
-  # Convert each dict to tuple of key-value pairs
-  messages_tuple = tuple(tuple(message.items()) for message in messages)
-  print("Fetching successful! Beginning processing task")
-  xml_emails = parse_xml_file(XML_FILE)
-  xml_emails_tuple = tuple(xml_emails)  # Convert set to tuple
-  process_messages(service, messages_tuple, xml_emails_tuple)
+  result = scan_mailbox(creds, count_mess, incremental, metrics=metrics,
+                        sketch_params=sketch_params, scope=scope,
+                        threads=args.threads)
+  return 0 if result is not None else 1
 
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
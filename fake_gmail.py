@@ -0,0 +1,335 @@
+"""
+An in-process stand-in for the parts of the Gmail API these scripts use,
+backed by a synthetic mailbox. Latency and 429 rates can be injected so the
+fetch paths can be measured without an account or real quota.
+"""
+
+import bisect
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import httplib2
+from googleapiclient.errors import HttpError
+
+SUBJECT_TEMPLATES = [
+    "Your weekly digest #{n}", "Thank you for applying to {company}",
+    "New jobs for “data” in {company}", "Your receipt from {company}",
+    "{company} newsletter: issue {n}", "Security alert for your account",
+    "Your order #{n} has shipped", "Re: meeting notes {n}",
+]
+MAX_BATCH_SIZE = 100
+MAX_MODIFY_IDS = 1000  # Most IDs users.messages.batchModify accepts
+SYSTEM_LABELS = ("INBOX", "UNREAD", "STARRED", "TRASH", "SPAM", "IMPORTANT")
+
+
+def generate_mailbox(messages, senders, zipf_exponent=1.1, thread_length=3,
+                     seed=0):
+  """Build a synthetic mailbox, newest message first.
+
+  Sender popularity follows a Zipf-like distribution, so a few senders
+  account for most mail as in a real inbox. Returns a list of message dicts
+  ({"id", "threadId", "from", "subject", "date", "internalDate"}).
+  """
+  rng = random.Random(seed)
+  domains = [f"company{i}.example.com" for i in range(max(1, senders // 5))]
+  addresses = [f"sender{i}@{rng.choice(domains)}" for i in range(senders)]
+  weights = [1 / (rank + 1) ** zipf_exponent for rank in range(senders)]
+  chosen = rng.choices(addresses, weights=weights, k=messages)
+
+  now = datetime(2024, 7, 1, tzinfo=timezone.utc)
+  mailbox = []
+  thread_id = None
+  for i, address in enumerate(chosen):
+    if i % thread_length == 0 or thread_id is None:
+      thread_id = f"{0x18f0000000000000 + messages - i:016x}"
+    date = now - timedelta(minutes=37 * i)
+    company = address.split("@")[1].split(".")[0]
+    mailbox.append({
+        "id": f"{0x18f0000000000000 + messages - i:016x}",
+        "threadId": thread_id,
+        "from": f"{company.title()} <{address}>",
+        "subject": rng.choice(SUBJECT_TEMPLATES).format(n=rng.randrange(1000),
+                                                        company=company),
+        "date": date.strftime("%a, %d %b %Y %H:%M:%S +0000"),
+        "internalDate": str(int(date.timestamp() * 1000)),
+    })
+  return mailbox
+
+
+def generate_filters_xml(file_path, entries, senders_per_entry=1, labels=20,
+                         seed=0):
+  """Write a mailFilters.xml with `entries` sender filters."""
+  rng = random.Random(seed)
+  with open(file_path, "w", encoding="utf-8") as f:
+    f.write("<?xml version='1.0' encoding='UTF-8'?>"
+            "<feed xmlns='http://www.w3.org/2005/Atom' "
+            "xmlns:apps='http://schemas.google.com/apps/2006'>\n"
+            "\t<title>Mail Filters</title>\n")
+    for i in range(entries):
+      senders = " OR ".join(f"filtered{i}x{j}@company{rng.randrange(500)}.example.org"
+                            for j in range(senders_per_entry))
+      f.write(
+          f"\t<entry>\n\t\t<category term='filter'></category>\n"
+          f"\t\t<title>Mail Filter</title>\n"
+          f"\t\t<id>tag:mail.google.com,2008:filter:{1000000 + i}</id>\n"
+          f"\t\t<updated>2024-07-01T00:00:00Z</updated>\n\t\t<content></content>\n"
+          f"\t\t<apps:property name='from' value='{senders}'/>\n"
+          f"\t\t<apps:property name='label' value='Label {i % labels}'/>\n"
+          f"\t\t<apps:property name='shouldArchive' value='true'/>\n"
+          f"\t</entry>\n")
+    f.write("</feed>\n")
+
+
+class FakeRequest:
+  def __init__(self, service, method, handler):
+    self.service = service
+    self.method = method
+    self.handler = handler
+
+  def execute(self, http=None, num_retries=0):
+    self.service.round_trip()
+    return self.service.call(self.method, self.handler)
+
+
+class FakeBatch:
+  def __init__(self, service, callback=None):
+    self.service = service
+    self.callback = callback
+    self.requests = []
+
+  def add(self, request, callback=None, request_id=None):
+    if len(self.requests) >= MAX_BATCH_SIZE:
+      raise ValueError(f"Batch requests are limited to {MAX_BATCH_SIZE} calls")
+    request_id = request_id or str(len(self.requests))
+    self.requests.append((request_id, request, callback or self.callback))
+
+  def execute(self, http=None):
+    self.service.round_trip()
+    self.service.count("batch")
+    for request_id, request, callback in self.requests:
+      try:
+        response, exception = self.service.call(request.method, request.handler), None
+      except HttpError as error:
+        response, exception = None, error
+      if callback:
+        callback(request_id, response, exception)
+
+
+class _Resource:
+  """Attribute-style access to handlers, e.g. service.users().messages()."""
+
+  def __init__(self, service, methods):
+    self._service = service
+    self._methods = methods
+
+  def __getattr__(self, name):
+    return self._methods[name]
+
+
+class FakeGmailService:
+  """Thread-safe fake of the Gmail v1 service object.
+
+  `latency` seconds are slept per HTTP round trip (one per request or per
+  batch), and each API call fails with a 429 with probability `error_rate`.
+  `calls` counts API calls by method.
+  """
+
+  def __init__(self, mailbox, latency=0.0, error_rate=0.0, history_id=1000,
+               seed=0):
+    self.mailbox = mailbox
+    self.by_id = {message["id"]: message for message in mailbox}
+    # Negated receive times, ascending since the mailbox is newest first
+    self.ages = [-(int(message["internalDate"]) // 1000) for message in mailbox]
+    self.threads = {}
+    for message in mailbox:
+      self.threads.setdefault(message["threadId"], []).append(message)
+    self.latency = latency
+    self.error_rate = error_rate
+    self.history_id = history_id
+    self.history = []  # (historyId, message) pairs for users.history.list
+    self.labels = [{"id": name, "name": name, "type": "system"}
+                   for name in SYSTEM_LABELS]
+    self.filters = []
+    self.message_labels = {}  # Message ID -> label IDs set by batchModify
+    self.calls = {}
+    self.lock = threading.Lock()
+    self.rng = random.Random(seed)
+
+  # Plumbing
+
+  def round_trip(self):
+    if self.latency:
+      time.sleep(self.latency)
+
+  def count(self, method):
+    with self.lock:
+      self.calls[method] = self.calls.get(method, 0) + 1
+
+  def call(self, method, handler):
+    self.count(method)
+    with self.lock:
+      failed = self.error_rate and self.rng.random() < self.error_rate
+    if failed:
+      raise HttpError(httplib2.Response({"status": 429, "retry-after": "1"}),
+                      b'{"error": {"code": 429, "message": "Rate Limit Exceeded"}}')
+    return handler()
+
+  def request(self, method, handler):
+    return FakeRequest(self, method, handler)
+
+  def new_batch_http_request(self, callback=None):
+    return FakeBatch(self, callback)
+
+  # Resources
+
+  def users(self):
+    return _Resource(self, {
+        "messages": lambda: _Resource(self, {
+            "list": self._messages_list, "get": self._messages_get,
+            "batchModify": self._messages_batch_modify}),
+        "labels": lambda: _Resource(self, {
+            "list": self._labels_list, "create": self._labels_create}),
+        "settings": lambda: _Resource(self, {
+            "filters": lambda: _Resource(self, {
+                "list": self._filters_list, "create": self._filters_create})}),
+        "threads": lambda: _Resource(self, {"get": self._threads_get}),
+        "history": lambda: _Resource(self, {"list": self._history_list}),
+        "getProfile": lambda userId: self.request(
+            "getProfile", lambda: {"historyId": str(self.history_id),
+                                   "messagesTotal": len(self.mailbox)}),
+    })
+
+  # Handlers
+
+  def matches_query(self, message, q):
+    if not q:
+      return True
+    timestamp = int(message["internalDate"]) // 1000
+    for op, value in re.findall(r"\b(after|before):(\d+)", q):
+      if (op == "after" and timestamp <= int(value)) or \
+         (op == "before" and timestamp >= int(value)):
+        return False
+    sender = message["from"].lower()
+    for negated, senders in re.findall(r"(-?)from:\(([^)]*)\)", q):
+      hit = any(term.strip().lower().lstrip("*@") in sender
+                for term in senders.split(" OR ") if term.strip())
+      if hit == bool(negated):
+        return False
+    return True
+
+  def date_range(self, q):
+    """Positions of the mailbox an after:/before: query can match."""
+    start, end = 0, len(self.mailbox)
+    for op, value in re.findall(r"\b(after|before):(\d+)", q or ""):
+      if op == "before":
+        start = max(start, bisect.bisect_right(self.ages, -int(value)))
+      else:
+        end = min(end, bisect.bisect_left(self.ages, -int(value)))
+    return start, end
+
+  def _messages_list(self, userId, maxResults=100, pageToken=None, q=None,
+                     labelIds=None, includeSpamTrash=False):
+    def handler():
+      start, end = self.date_range(q)
+      position = max(start, int(pageToken or 0))
+      page = []
+      while position < end and len(page) < min(maxResults, 500):
+        message = self.mailbox[position]
+        position += 1
+        if self.matches_query(message, q):
+          page.append({"id": message["id"], "threadId": message["threadId"]})
+      result = {}
+      if page:
+        result["messages"] = page
+      if position < end:
+        result["nextPageToken"] = str(position)
+      if pageToken is None:
+        result["resultSizeEstimate"] = sum(
+            1 for message in self.mailbox[start:end]
+            if self.matches_query(message, q))
+      return result
+    return self.request("messages.list", handler)
+
+  def _headers(self, message, names):
+    headers = [{"name": "From", "value": message["from"]},
+               {"name": "Subject", "value": message["subject"]},
+               {"name": "Date", "value": message["date"]}]
+    return [header for header in headers if not names or header["name"] in names]
+
+  def _messages_get(self, userId, id, format="full", metadataHeaders=None):
+    def handler():
+      message = self.by_id.get(id)
+      if message is None:
+        raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+      return {"id": id, "threadId": message["threadId"],
+              "internalDate": message["internalDate"],
+              "payload": {"headers": self._headers(message, metadataHeaders)}}
+    return self.request("messages.get", handler)
+
+  def _threads_get(self, userId, id, format="full", metadataHeaders=None):
+    def handler():
+      messages = self.threads.get(id)
+      if messages is None:
+        raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+      return {"id": id, "messages": [
+          {"id": message["id"], "threadId": id,
+           "internalDate": message["internalDate"],
+           "payload": {"headers": self._headers(message, metadataHeaders)}}
+          for message in messages]}
+    return self.request("threads.get", handler)
+
+  def _history_list(self, userId, startHistoryId, historyTypes=None,
+                    pageToken=None):
+    def handler():
+      if int(startHistoryId) < self.history_id - 100000:
+        raise HttpError(httplib2.Response({"status": 404}), b"Not Found")
+      added = [{"id": str(history_id), "messagesAdded": [
+          {"message": {"id": message["id"], "threadId": message["threadId"]}}]}
+          for history_id, message in self.history
+          if history_id > int(startHistoryId)]
+      return {"history": added, "historyId": str(self.history_id)}
+    return self.request("history.list", handler)
+
+  def _messages_batch_modify(self, userId, body):
+    def handler():
+      if len(body.get("ids", [])) > MAX_MODIFY_IDS:
+        raise HttpError(httplib2.Response({"status": 400}), b"Bad Request")
+      with self.lock:
+        for message_id in body.get("ids", []):
+          labels = self.message_labels.setdefault(message_id, {"INBOX"})
+          labels.update(body.get("addLabelIds", []))
+          labels.difference_update(body.get("removeLabelIds", []))
+      return ""
+    return self.request("messages.batchModify", handler)
+
+  def _labels_list(self, userId):
+    def handler():
+      with self.lock:
+        return {"labels": [dict(label) for label in self.labels]}
+    return self.request("labels.list", handler)
+
+  def _labels_create(self, userId, body):
+    def handler():
+      with self.lock:
+        if any(label["name"] == body["name"] for label in self.labels):
+          raise HttpError(httplib2.Response({"status": 409}), b"Label name exists")
+        label = {**body, "id": f"Label_{len(self.labels)}", "type": "user"}
+        self.labels.append(label)
+        return dict(label)
+    return self.request("labels.create", handler)
+
+  def _filters_list(self, userId):
+    def handler():
+      with self.lock:
+        return {"filter": [dict(gmail_filter) for gmail_filter in self.filters]}
+    return self.request("filters.list", handler)
+
+  def _filters_create(self, userId, body):
+    def handler():
+      with self.lock:
+        gmail_filter = {**body, "id": f"filter{len(self.filters)}"}
+        self.filters.append(gmail_filter)
+        return dict(gmail_filter)
+    return self.request("filters.create", handler)
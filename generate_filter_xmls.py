@@ -1,9 +1,31 @@
 import os
-import shutil
+import sys
+import argparse
+import hashlib
+import itertools
+import json
+import sqlite3
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from xml.sax.saxutils import escape, quoteattr
 from datetime import datetime
 import logging
+import sender_matcher
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+APPS_NS = "http://schemas.google.com/apps/2006"
+MAX_CRITERIA_LENGTH = 1500  # Longest `from` criterion Gmail reliably accepts
+OR_SEPARATOR = " OR "
+INDENT = "   "
+DIFF_FILE = 'filter_diff.json'
+MANIFEST_FILE = 'filter_manifest.db'  # (sender, label) pairs already written out
+DELTA_FILE = 'deltaMailFilters.xml'  # Filters for the tags added since the last import
+TAIL_BYTES = 256  # Bytes before the saved offset hashed to spot a rewritten input
+NO_LABEL = ''  # Index key for filters that do not apply a label
+SEARCH_CRITERIA = ('to', 'subject', 'hasTheWord', 'doesNotHaveTheWord',
+                   'hasAttachment', 'excludeChats', 'size')
+PLACEHOLDER_ID = 'tag:mail.google.com,2008:filter:PLACEHOLDER_TEXT'
+DEFAULT_ACTIONS = [('shouldArchive', 'true'), ('shouldNeverSpam', 'true'),
+                   ('sizeOperator', 's_sl'), ('sizeUnit', 's_smb')]
 
 
 def handle_file_operation(file_path, operation, mode="r", content=None):
@@ -21,159 +43,487 @@ def handle_file_operation(file_path, operation, mode="r", content=None):
     raise IOError(f"Error during file operation on {file_path}: {str(e)}")
 
 
-def parse_xml_file(file_path):
+def filter_criteria(properties):
+  """Normalized criteria of one filter: each `from` sender on its own, plus
+  any other search criteria, as "name:value" strings.
+  """
+  criteria = set()
+  for name, value in properties:
+    if name == 'from':
+      criteria.update(f"from:{sender.lower()}"
+                      for sender in sender_matcher.split_criteria(value or ''))
+    elif name in SEARCH_CRITERIA:
+      criteria.add(f"{name}:{value}")
+  return criteria
+
+
+def index_filters(entries, index):
+  """Pass filter entries through unchanged while adding each one to a
+  label -> set-of-criteria index, so indexing never needs its own parse.
+  """
+  for entry in entries:
+    label = dict(entry["properties"]).get('label', NO_LABEL)
+    index.setdefault(label, set()).update(filter_criteria(entry["properties"]))
+    yield entry
+
+
+def index_filter_file(file_path):
+  """Parse a filter file once into a label -> set-of-criteria index."""
+  index = {}
+  for _ in index_filters(iter_filter_entries(file_path), index):
+    pass
+  return index
+
+
+def diff_filter_indexes(old, new):
+  """Per-label set difference between two filter indexes."""
+  added = {}
+  removed = {}
+  for label in sorted(old.keys() | new.keys()):
+    label_added = new.get(label, set()) - old.get(label, set())
+    label_removed = old.get(label, set()) - new.get(label, set())
+    if label_added:
+      added[label] = sorted(label_added)
+    if label_removed:
+      removed[label] = sorted(label_removed)
+  return {
+      'labels_added': sorted(new.keys() - old.keys()),
+      'labels_removed': sorted(old.keys() - new.keys()),
+      'added': added,
+      'removed': removed,
+      'summary': {'criteria_added': sum(map(len, added.values())),
+                  'criteria_removed': sum(map(len, removed.values()))},
+  }
+
+
+def print_diff(diff):
+  summary = diff['summary']
+  print(f"{summary['criteria_added']} criteria added, "
+        f"{summary['criteria_removed']} removed.")
+  for label in diff['labels_added']:
+    print(f"  New label: {label}")
+  for label in diff['labels_removed']:
+    print(f"  Label no longer filtered: {label}")
+  for label, criteria in diff['removed'].items():
+    print(f"  {label}: -{len(criteria)} ({', '.join(criteria[:5])}"
+          f"{', ...' if len(criteria) > 5 else ''})")
+
+
+def pack_criteria(senders, limit=MAX_CRITERIA_LENGTH):
+  """Bin-pack senders into as few "a OR b OR ..." criteria as fit in `limit`.
+
+  First-fit decreasing: longest senders first, each into the first bin with
+  room left.
+  """
+  bins = []
+  for sender in sorted(senders, key=len, reverse=True):
+    for packed in bins:
+      if packed["length"] + len(OR_SEPARATOR) + len(sender) <= limit:
+        packed["senders"].append(sender)
+        packed["length"] += len(OR_SEPARATOR) + len(sender)
+        break
+    else:
+      bins.append({"senders": [sender], "length": len(sender)})
+  return [OR_SEPARATOR.join(sorted(packed["senders"], key=str.lower))
+          for packed in bins]
+
+
+def new_filter_properties(tag):
+  return [("label", tag)] + DEFAULT_ACTIONS
+
+
+def iter_filter_entries(file_path, feed=None):
+  """Stream the filters of a mailFilters.xml with iterparse.
+
+  Yields {"id", "updated", "properties"} dicts, where properties is the
+  ordered list of (name, value) pairs. Each entry is dropped from the tree
+  once yielded, so memory stays flat however many filters the file holds.
+  Feed-level elements (title, id, author, ...) are appended to
+  feed["children"] when a `feed` dict is passed.
+  """
+  depth = 0
+  root = None
   try:
-    tree = ET.parse(file_path)
-    return tree.getroot()
+    for event, element in ET.iterparse(file_path, events=("start", "end")):
+      if event == "start":
+        if root is None:
+          root = element
+        depth += 1
+        continue
+      depth -= 1
+      if depth != 1:
+        continue
+      if element.tag == f"{{{ATOM_NS}}}entry":
+        entry_id = element.find(f"{{{ATOM_NS}}}id")
+        updated = element.find(f"{{{ATOM_NS}}}updated")
+        yield {
+            "id": entry_id.text if entry_id is not None else None,
+            "updated": updated.text if updated is not None else None,
+            "properties": [(prop.get('name'), prop.get('value'))
+                           for prop in element.iterfind(f"{{{APPS_NS}}}property")],
+        }
+      elif feed is not None:
+        feed.setdefault("children", []).append(element)
+        continue
+      root.remove(element)
   except ET.ParseError as e:
     raise ValueError(f"XML parsing error in {file_path}: {str(e)}")
-  except Exception as e:
-    raise Exception(
-        f"An unexpected error occurred while parsing {file_path}: {str(e)}")
-
-
-def get_label_email_pairs(root):
-  ns = {"ns": "http://www.w3.org/2005/Atom",
-        "apps": "http://schemas.google.com/apps/2006"}
-  pairs = {}
-  for entry in root.findall("ns:entry", ns):
-    label = entry.find('apps:property[@name="label"]', ns)
-    email = entry.find('apps:property[@name="from"]', ns)
-    if label is not None and email is not None:
-      pairs[label.get('value')] = email.get('value')
-  return pairs
 
 
-def update_xml_with_emails(xml_root, emails):
-  labels = {}
+def _local_name(tag):
+  return tag.rsplit("}", 1)[-1]
+
+
+def _write_element(f, element, depth):
+  """Write a small feed-level element (and its children) indented."""
+  indent = INDENT * depth
+  name = _local_name(element.tag)
+  attributes = "".join(f" {_local_name(key)}={quoteattr(value)}"
+                       for key, value in element.attrib.items())
+  text = (element.text or "").strip()
+  if len(element):
+    f.write(f"{indent}<{name}{attributes}>\n")
+    for child in element:
+      _write_element(f, child, depth + 1)
+    f.write(f"{indent}</{name}>\n")
+  elif text:
+    f.write(f"{indent}<{name}{attributes}>{escape(text)}</{name}>\n")
+  else:
+    f.write(f"{indent}<{name}{attributes}/>\n")
+
+
+def write_filters(file_path, entries, feed=None):
+  """Write filter entries to file_path as they are produced.
+
+  Nothing is built up in memory: each entry is indented and written
+  straight to the file, and the number of entries written is returned.
+  """
+  count = 0
+  # Pulling the first entry makes the reader collect the feed-level
+  # elements that precede it
+  entries = iter(entries)
+  first = next(entries, None)
+  with open(file_path, "w", encoding="utf-8") as f:
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    f.write(f'<feed xmlns="{ATOM_NS}" xmlns:apps="{APPS_NS}">\n')
+    for child in (feed or {}).get("children", []):
+      _write_element(f, child, 1)
+    for entry in itertools.chain([first] if first else [], entries):
+      updated = entry.get("updated") or datetime.now().isoformat() + 'Z'
+      f.write(f"{INDENT}<entry>\n"
+              f"{INDENT * 2}<category term=\"filter\"/>\n"
+              f"{INDENT * 2}<title>Mail Filter</title>\n"
+              f"{INDENT * 2}<id>{escape(entry.get('id') or PLACEHOLDER_ID)}</id>\n"
+              f"{INDENT * 2}<updated>{escape(updated)}</updated>\n"
+              f"{INDENT * 2}<content/>\n")
+      for name, value in entry["properties"]:
+        f.write(f"{INDENT * 2}<apps:property name={quoteattr(name)} "
+                f"value={quoteattr(value)}/>\n")
+      f.write(f"{INDENT}</entry>\n")
+      count += 1
+    f.write("</feed>\n")
+  return count
+
+
+def consolidate_filters(entries, emails):
+  """Add the tagged emails to the filter entries with as few filters as possible.
+
+  Existing filters and new tags that share every property except `from`
+  (same label, same actions, same other criteria) are merged into one
+  group, whose senders are then bin-packed into "a OR b OR ..." criteria
+  under MAX_CRITERIA_LENGTH. This takes the filter count from one per
+  sender down to roughly one per label. Filters without a sender criterion
+  are passed through unchanged as soon as they are read.
+  """
   print("\n")
-  ET.register_namespace('', 'http://www.w3.org/2005/Atom')
-  ET.register_namespace('apps', 'http://schemas.google.com/apps/2006')
+  groups = {}
+
+  def group_for(properties, entry_id=None):
+    key = tuple(sorted(properties))
+    if key not in groups:
+      groups[key] = {"properties": properties, "id": entry_id,
+                     "senders": {}}
+    return groups[key]
+
+  for entry in entries:
+    properties = []
+    senders = None
+    for name, value in entry["properties"]:
+      if name == 'from':
+        senders = sender_matcher.split_criteria(value or '')
+      else:
+        properties.append((name, value))
+    if not senders:
+      yield entry
+      continue
+    group = group_for(properties, entry["id"])
+    group["senders"].update((sender.lower(), sender) for sender in senders)
+
   for email, tags in emails.items():
     for tag in tags:
-      if tag in labels:
-        labels[tag] += ' OR ' + email
+      group = group_for(new_filter_properties(tag))
+      if group["senders"]:
         print(
             f'Label "{tag}" exists. Appending email "{email}" to it.')
       else:
-        labels[tag] = email
         print(
             f'Label "{tag}" does not exist. Creating it with email "{email}".')
-
-      entry = ET.SubElement(xml_root, 'entry', {})
-      category = ET.SubElement(
-          entry, 'category', attrib={'term': 'filter'})
-      category.text = ''
-      ET.SubElement(entry, 'title').text = 'Mail Filter'
-      ET.SubElement(
-          entry, 'id').text = 'tag:mail.google.com,2008:filter:PLACEHOLDER_TEXT'
-      ET.SubElement(
-          entry, 'updated').text = datetime.now().isoformat() + 'Z'
-      content = ET.SubElement(entry, 'content')
-      content.text = ''
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'from', 'value': email})
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'label', 'value': tag})
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'shouldArchive', 'value': 'true'})
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'shouldNeverSpam', 'value': 'true'})
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'sizeOperator', 'value': 's_sl'})
-      ET.SubElement(entry, 'apps:property', {
-                    'name': 'sizeUnit', 'value': 's_smb'})
-
-
-def pretty_print_xml(xml_root):
-  rough_string = ET.tostring(xml_root, 'utf-8')
-  reparsed = minidom.parseString(rough_string)
-  return '\n'.join([line for line in reparsed.toprettyxml(indent="   ").split('\n') if line.strip()])
-
-
-def process_email_updates(input_file: str, old_file: str, output_file: str) -> None:
+      group["senders"].setdefault(email.lower(), email)
+
+  filter_count = 0
+  for group in groups.values():
+    for i, criteria in enumerate(pack_criteria(group["senders"].values())):
+      yield {"id": group["id"] if i == 0 else None, "updated": None,
+             "properties": [('from', criteria)] + group["properties"]}
+      filter_count += 1
+
+  sender_count = sum(len(group["senders"]) for group in groups.values())
+  print(f"\n{sender_count} senders consolidated into {filter_count} filters.")
+
+
+def process_email_updates(input_file: str, old_file: str, output_file: str,
+                          diff_file: str = DIFF_FILE, emails: dict = None,
+                          manifest_file: str = MANIFEST_FILE):
+  """Write output_file and return the diff against old_file.
+
+  Each XML file is parsed exactly once: the old filters and the generated
+  ones are indexed as they stream through, and only a previous output file
+  (if any) gets a read of its own. The diff is also written to diff_file as
+  JSON so it can gate the deployment of the new filters. emails, the
+  {email: [tags]} assignments, is read from input_file unless given. The
+  tags are recorded in manifest_file, so a later incremental run only
+  emits tags added after this one.
+  """
   try:
-    files = [input_file, old_file]
+    files = [old_file] if emails is not None else [input_file, old_file]
     for file in files:
       if not os.path.exists(file):
         raise FileNotFoundError(f"File {file} does not exist.")
 
-    old_parsed = parse_xml_file(old_file)
-
     logfile = 'logging_file.log'
     if os.path.exists(logfile):
       os.remove(logfile)
     logging.basicConfig(filename=logfile, level=logging.INFO)
 
-    emails = get_emails_from_update_file(input_file)
-    update_xml_with_emails(old_parsed, emails)
-    pretty_xml_str = pretty_print_xml(old_parsed)
+    if emails is None:
+      emails = get_emails_from_update_file(input_file)
 
-    temp_file = None
+    previous_index = None
     if os.path.exists(output_file):
-      temp_file = 'temp.xml'
-      shutil.copy(output_file, temp_file)
-
-    handle_file_operation(output_file, 'write', 'w', pretty_xml_str)
+      previous_index = index_filter_file(output_file)
+
+    feed = {}
+    old_index = {}
+    output_index = {}
+    entries = index_filters(
+        consolidate_filters(
+            index_filters(iter_filter_entries(old_file, feed), old_index),
+            emails),
+        output_index)
+    write_filters(output_file, entries, feed)
+    if manifest_file:
+      with open_manifest(manifest_file) as manifest:
+        record_emitted(manifest, emails, input_file)
 
     logging.info(f"Input file: {input_file}, Key-value pairs: {emails}")
-    logging.info(
-        f"Old file: {old_file}, Key-value pairs: {get_label_email_pairs(old_parsed)}")
-    logging.info(f"Output file: {
-                 output_file}, Key-value pairs: {get_label_email_pairs(parse_xml_file(output_file))}")
+    logging.info(f"Old file: {old_file}, Key-value pairs: {old_index}")
+    logging.info(f"Output file: {output_file}, Key-value pairs: {output_index}")
     print("\nLog file " + logfile + " created successfully.")
 
-    if temp_file:
-      temp_parsed = parse_xml_file(temp_file)
-
-      print(f"\nComparing original XML files before any changes: {
-            old_file} and {temp_file}")
-      differences = compare_xml_files(old_file, temp_file)
-      print(differences)
-
-      print(f"\nComparing XML files after updates: {
-            temp_file} and {output_file}")
-      differences = compare_xml_files(temp_file, output_file)
-      print(differences)
-
-      logging.info(f"Temp file: {
-                   temp_file}, Key-value pairs: {get_label_email_pairs(temp_parsed)}")
-
-      os.remove(temp_file)
+    diff = diff_filter_indexes(old_index, output_index)
+    print(f"\nChanges from {old_file} to {output_file}:")
+    print_diff(diff)
+    report = {'old_file': old_file, 'output_file': output_file,
+              'changes': diff}
+    if previous_index is not None:
+      report['since_previous_output'] = diff_filter_indexes(
+          previous_index, output_index)
+      print(f"\nChanges since the previous {output_file}:")
+      print_diff(report['since_previous_output'])
+
+    with open(diff_file, 'w', encoding='utf-8') as f:
+      json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nDiff written to {diff_file}.")
 
     print("XML file updated successfully.")
+    return diff
   except Exception as e:
     print(f"An error occurred: {e}")
+    return None
 
 
 def get_emails_from_update_file(update_file):
+  return parse_update_lines(handle_file_operation(update_file, 'read'))
+
+
+def parse_update_lines(lines):
+  """{email: [tags]} from "email: tag1, tag2" lines."""
   emails = {}
-  lines = handle_file_operation(update_file, 'read')
   for line in lines:
     try:
-      email, tag = line.strip().split(': ')
-      emails.setdefault(email, []).append(tag)
+      email, tags = line.strip().split(': ')
+      for tag in tags.split(', '):
+        if tag not in emails.setdefault(email, []):
+          emails[email].append(tag)
     except ValueError:
       print(f"Skipping malformed line: {line.strip()}")
   return emails
 
 
-def compare_xml_files(file1, file2):
-  root1 = parse_xml_file(file1)
-  root2 = parse_xml_file(file2)
+def pair_hash(email, tag):
+  """64-bit content hash of one (sender, label) pair."""
+  digest = hashlib.blake2b(f"{email.lower()}\0{tag}".encode("utf-8"),
+                           digest_size=8).digest()
+  return int.from_bytes(digest, "big", signed=True)
+
+
+def open_manifest(manifest_file=MANIFEST_FILE):
+  """Open (and create if needed) the manifest of emitted tags.
+
+  It holds the hash of every (sender, label) pair written out so far, plus
+  how far into the tag file those came from and a hash of the bytes just
+  before that offset. Used as a context manager, a block's changes are
+  committed together.
+  """
+  conn = sqlite3.connect(manifest_file)
+  conn.execute("CREATE TABLE IF NOT EXISTS pairs (hash INTEGER PRIMARY KEY)")
+  conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+  conn.commit()
+  return conn
+
+
+def get_state(manifest, key):
+  row = manifest.execute("SELECT value FROM state WHERE key = ?",
+                         (key,)).fetchone()
+  return row[0] if row else None
+
+
+def set_state(manifest, key, value):
+  manifest.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                   (key, value))
+
+
+def tail_hash(f, offset):
+  """Hash of the TAIL_BYTES of an open binary file that end at offset."""
+  start = max(0, offset - TAIL_BYTES)
+  f.seek(start)
+  return hashlib.sha256(f.read(offset - start)).hexdigest()
+
+
+def record_emitted(manifest, emails, input_file, offset=None):
+  """Mark the tags in emails as emitted and input_file as read up to offset
+  (its end by default)."""
+  manifest.executemany("INSERT OR IGNORE INTO pairs (hash) VALUES (?)",
+                       (((pair_hash(email, tag),) for email, tags in emails.items()
+                         for tag in tags)))
+  if not os.path.exists(input_file):
+    return
+  with open(input_file, "rb") as f:
+    if offset is None:
+      offset = os.fstat(f.fileno()).st_size
+    set_state(manifest, "offset", offset)
+    set_state(manifest, "tail", tail_hash(f, offset))
+
+
+def read_new_lines(input_file, offset, tail):
+  """Return (lines, end offset, restarted) for the complete lines after offset.
+
+  If the bytes before offset no longer hash to tail, the file was edited
+  rather than appended to, and it is read again from the start. A last line
+  without its newline yet is left for the next run.
+  """
+  with open(input_file, "rb") as f:
+    size = os.fstat(f.fileno()).st_size
+    restarted = offset > size or tail_hash(f, offset) != tail
+    if restarted:
+      offset = 0
+    f.seek(offset)
+    data = f.read()
+  end = data.rfind(b"\n") + 1
+  return data[:end].decode("utf-8").splitlines(), offset + end, restarted
+
+
+def process_incremental_updates(input_file: str, old_file: str,
+                                delta_file: str = DELTA_FILE,
+                                manifest_file: str = MANIFEST_FILE):
+  """Write only the tags added to input_file since the last run to delta_file.
+
+  Only the lines appended after the offset saved in the manifest are read,
+  and pairs whose hash is already in it are skipped, so the work depends on
+  what was tagged since the last run rather than on the whole history. The
+  first run seeds the manifest from the senders of old_file. The new
+  filters are merged into a delta_file that has not been imported yet.
+  Returns the {email: [tags]} that were new, or None on error.
+  """
+  try:
+    if not os.path.exists(input_file):
+      raise FileNotFoundError(f"File {input_file} does not exist.")
+    with open_manifest(manifest_file) as manifest:
+      offset = get_state(manifest, "offset")
+      if offset is None and os.path.exists(old_file):
+        manifest.executemany(
+            "INSERT OR IGNORE INTO pairs (hash) VALUES (?)",
+            ((pair_hash(criterion[len("from:"):], label),)
+             for label, criteria in index_filter_file(old_file).items()
+             for criterion in criteria if criterion.startswith("from:")))
+      lines, end, restarted = read_new_lines(input_file, offset or 0,
+                                             get_state(manifest, "tail"))
+      if restarted and offset:
+        print(f"{input_file} was edited since the last run. Reading it again; "
+              "tags already written out are still skipped.")
+
+      emails = {}
+      for email, tags in parse_update_lines(lines).items():
+        for tag in tags:
+          if not manifest.execute("SELECT 1 FROM pairs WHERE hash = ?",
+                                  (pair_hash(email, tag),)).fetchone():
+            emails.setdefault(email, []).append(tag)
+      if not emails:
+        record_emitted(manifest, {}, input_file, end)
+        print("No new tags since the last run.")
+        return emails
+
+      # Tags of a delta that was not imported yet are carried over
+      previous = iter_filter_entries(delta_file) \
+          if os.path.exists(delta_file) else iter(())
+      title = ET.Element(f"{{{ATOM_NS}}}title")
+      title.text = "Mail Filters"
+      temp_file = delta_file + ".tmp"
+      count = write_filters(temp_file, consolidate_filters(previous, emails),
+                            {"children": [title]})
+      os.replace(temp_file, delta_file)
+      record_emitted(manifest, emails, input_file, end)
+
+    tag_count = sum(map(len, emails.values()))
+    print(f"{tag_count} new tags written to {delta_file} ({count} filters). "
+          "Import it into Gmail, then delete it so the next run starts a new "
+          "one.")
+    return emails
+  except Exception as e:
+    print(f"An error occurred: {e}")
+    return None
 
-  pairs1 = get_label_email_pairs(root1)
-  pairs2 = get_label_email_pairs(root2)
 
-  additions = {k: v for k, v in pairs2.items() if k not in pairs1}
-  deletions = {k: v for k, v in pairs1.items() if k not in pairs2}
-  modifications = {k: (pairs1[k], pairs2[k])
-                   for k in pairs1 if k in pairs2 and pairs1[k] != pairs2[k]}
+def compare_xml_files(file1, file2):
+  return diff_filter_indexes(index_filter_file(file1), index_filter_file(file2))
 
-  return {'additions': additions, 'deletions': deletions, 'modifications': modifications}
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description="Generate newMailFilters.xml from mailFilters.xml and the "
+      "tags in xmlupdate.txt.")
+  parser.add_argument("--incremental", action="store_true",
+                      help=f"only write the tags added since the last run, to "
+                      f"{DELTA_FILE}")
+  args = parser.parse_args(argv)
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+  if args.incremental:
+    result = process_incremental_updates('xmlupdate.txt', 'mailFilters.xml')
+  else:
+    result = process_email_updates(
+        'xmlupdate.txt', 'mailFilters.xml', 'newMailFilters.xml')
+  return 0 if result is not None else 1
 
 
 if __name__ == "__main__":
-  os.chdir(os.path.dirname(os.path.abspath(__file__)))
-  process_email_updates(
-      'xmlupdate.txt', 'mailFilters.xml', 'newMailFilters.xml')
+  sys.exit(main())
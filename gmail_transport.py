@@ -0,0 +1,125 @@
+import os
+import pickle
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 10  # Keep-alive connections kept open to the Gmail API
+HTTP_TIMEOUT = 60  # Seconds before a request is abandoned
+REFRESH_MARGIN = timedelta(minutes=5)  # Refresh access tokens this long before expiry
+# Headers describing a body that requests has already decoded
+DECODED_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class CredentialsManager:
+  """Shares one set of OAuth credentials between threads.
+
+  The access token is refreshed ahead of its expiry, by a single thread while
+  the others wait, and the refreshed token is written back to token_file
+  atomically, so a long scan never stalls on an expired token.
+  """
+
+  def __init__(self, credentials, token_file=None):
+    self.credentials = credentials
+    self.token_file = token_file
+    self.lock = threading.Lock()
+
+  def needs_refresh(self):
+    expiry = self.credentials.expiry
+    if not self.credentials.token:
+      return True
+    if expiry is None:
+      return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return expiry - now < REFRESH_MARGIN
+
+  def token(self):
+    """Return a valid access token, refreshing it first if it expires soon."""
+    if self.needs_refresh():
+      self.refresh()
+    return self.credentials.token
+
+  def refresh(self, stale_token=None):
+    """Refresh the credentials unless another thread already did.
+
+    stale_token is the token a request was rejected with; if the current
+    token differs it was refreshed meanwhile and is used as is.
+    """
+    from google.auth.transport.requests import Request
+
+    with self.lock:
+      if stale_token is not None and self.credentials.token != stale_token:
+        return
+      if stale_token is None and not self.needs_refresh():
+        return
+      self.credentials.refresh(Request())
+      logging.info("Refreshed the access token.")
+      self.save()
+
+  def save(self):
+    if not self.token_file:
+      return
+    temp_file = self.token_file + ".tmp"
+    with open(temp_file, "wb") as token:
+      pickle.dump(self.credentials, token)
+    os.replace(temp_file, self.token_file)
+
+
+class PooledHttp:
+  """A thread-safe, httplib2.Http-compatible transport for googleapiclient.
+
+  Requests go through one requests.Session whose connection pool keeps
+  connections alive, so worker threads share connections instead of paying
+  a TLS handshake each, and every request is authorized with the manager's
+  current token.
+  """
+
+  def __init__(self, credentials_manager, pool_size=POOL_SIZE,
+               timeout=HTTP_TIMEOUT):
+    self.credentials_manager = credentials_manager
+    self.timeout = timeout
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          pool_block=True)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+
+  @property
+  def credentials(self):
+    # Lets googleapiclient authorize the parts of batch requests
+    return self.credentials_manager.credentials
+
+  def request(self, uri, method="GET", body=None, headers=None,
+              redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+    headers = dict(headers or {})
+    token = self.credentials_manager.token()
+    headers["authorization"] = f"Bearer {token}"
+    response = self.session.request(method, uri, data=body, headers=headers,
+                                    timeout=self.timeout)
+    if response.status_code == 401:
+      # Revoked or expired early: refresh once and retry
+      self.credentials_manager.refresh(stale_token=token)
+      headers["authorization"] = f"Bearer {self.credentials_manager.credentials.token}"
+      response = self.session.request(method, uri, data=body, headers=headers,
+                                      timeout=self.timeout)
+
+    info = {key.lower(): value for key, value in response.headers.items()
+            if key.lower() not in DECODED_HEADERS}
+    info["status"] = str(response.status_code)
+    resp = httplib2.Response(info)
+    resp.reason = response.reason
+    return resp, response.content
+
+  def close(self):
+    self.session.close()
+
+
+def build_service(credentials_manager, pool_size=POOL_SIZE):
+  """Build a Gmail service on a pooled transport; safe to share between threads."""
+  from googleapiclient.discovery import build
+
+  return build("gmail", "v1", http=PooledHttp(credentials_manager, pool_size))
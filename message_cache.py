@@ -0,0 +1,48 @@
+import sqlite3
+
+CACHE_FILE = "message_cache.db"  # On-disk cache of fetched message headers
+QUERY_CHUNK = 500  # Stay well below SQLite's bound-parameter limit
+
+
+def open_cache(cache_file=CACHE_FILE):
+  """Open (and create if needed) the message metadata cache."""
+  conn = sqlite3.connect(cache_file)
+  conn.execute("""
+      CREATE TABLE IF NOT EXISTS messages (
+        id TEXT PRIMARY KEY,
+        sender TEXT,
+        subject TEXT,
+        date TEXT
+      )""")
+  conn.commit()
+  return conn
+
+
+def store_messages(conn, rows):
+  """Insert (id, sender, subject, date) rows and commit them."""
+  conn.executemany(
+      "INSERT OR REPLACE INTO messages (id, sender, subject, date) "
+      "VALUES (?, ?, ?, ?)", rows)
+  conn.commit()
+
+
+def get_cached(conn, message_ids):
+  """Return {id: (sender, subject, date)} for the IDs already in the cache."""
+  cached = {}
+  for start in range(0, len(message_ids), QUERY_CHUNK):
+    chunk = message_ids[start:start + QUERY_CHUNK]
+    placeholders = ", ".join("?" * len(chunk))
+    for message_id, sender, subject, date in conn.execute(
+        f"SELECT id, sender, subject, date FROM messages "
+        f"WHERE id IN ({placeholders})", chunk):
+      cached[message_id] = (sender, subject, date)
+  return cached
+
+
+def iter_cached(conn):
+  """Yield (id, sender, subject, date) for every cached message."""
+  yield from conn.execute("SELECT id, sender, subject, date FROM messages")
+
+
+def count_cached(conn):
+  return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
@@ -0,0 +1,112 @@
+import os
+import mmap
+import hashlib
+from array import array
+
+LISTED_IDS_FILE = "listed_ids.bin"  # Message IDs of an unfinished full scan
+HEADER_FIELDS = 4  # magic, scan key, historyId, message count
+MAGIC = 0x31534449534D47  # "GMSIDS1" in the first word of a saved store
+
+
+def scan_key(*parts):
+  """64-bit fingerprint of what a listing was made with (query, count...)."""
+  digest = hashlib.blake2b(repr(parts).encode("utf-8"), digest_size=8).digest()
+  return int.from_bytes(digest, "little")
+
+
+class MessageIdStore:
+  """Message and thread IDs kept as two parallel array('Q') columns.
+
+  Gmail IDs are hex strings of up to 16 digits, so each one fits a 64-bit
+  integer: a listed message costs 16 bytes instead of a dict and two
+  strings. Iterating yields the usual {"id", "threadId"} dicts, built one
+  at a time. A store can be saved to a flat file (a small header, then each
+  column in native byte order) and memory-mapped back read-only, so a
+  resumed scan or another process reads it without copying it.
+  """
+
+  def __init__(self, ids=None, thread_ids=None, mapping=None):
+    self.ids = array("Q") if ids is None else ids
+    self.thread_ids = array("Q") if thread_ids is None else thread_ids
+    self.mapping = mapping
+    self.history_id = None
+
+  @classmethod
+  def from_messages(cls, messages):
+    store = cls()
+    for message in messages:
+      store.append(message)
+    return store
+
+  def append(self, message):
+    self.ids.append(int(message["id"], 16))
+    self.thread_ids.append(int(message.get("threadId") or "0", 16))
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, index):
+    return self.message(self.ids[index], self.thread_ids[index])
+
+  def __iter__(self):
+    for message_id, thread_id in zip(self.ids, self.thread_ids):
+      yield self.message(message_id, thread_id)
+
+  def pairs(self):
+    """(id, threadId) integer pairs, without building any dict."""
+    return zip(self.ids, self.thread_ids)
+
+  @staticmethod
+  def message(message_id, thread_id):
+    # Gmail IDs never start with a zero digit, so unpadded hex round-trips
+    message = {"id": f"{message_id:x}"}
+    if thread_id:
+      message["threadId"] = f"{thread_id:x}"
+    return message
+
+  def save(self, path, key=0, history_id=None):
+    """Write the store to path atomically."""
+    header = array("Q", [MAGIC, key, int(history_id or 0), len(self.ids)])
+    temp_file = path + ".tmp"
+    with open(temp_file, "wb") as f:
+      header.tofile(f)
+      f.write(self.ids)
+      f.write(self.thread_ids)
+    os.replace(temp_file, path)
+
+  @classmethod
+  def load(cls, path, key=None):
+    """Memory-map a saved store, or return None if there is none or it was
+    saved for a different key."""
+    try:
+      with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):  # ValueError: empty file
+      return None
+    try:
+      words = memoryview(mapping).cast("Q")
+    except TypeError:  # Not a whole number of words: truncated or foreign
+      mapping.close()
+      return None
+    if len(words) < HEADER_FIELDS:
+      words.release()
+      mapping.close()
+      return None
+    magic, saved_key, history_id, count = words[:HEADER_FIELDS]
+    if magic != MAGIC or (key is not None and saved_key != key) or \
+       len(words) != HEADER_FIELDS + 2 * count:
+      words.release()
+      mapping.close()
+      return None
+    store = cls(words[HEADER_FIELDS:HEADER_FIELDS + count],
+                words[HEADER_FIELDS + count:], mapping)
+    store.history_id = str(history_id) if history_id else None
+    return store
+
+  def close(self):
+    """Release a memory-mapped store's file."""
+    if self.mapping is not None:
+      self.ids.release()
+      self.thread_ids.release()
+      self.mapping.close()
+      self.mapping = None
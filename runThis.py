@@ -1,54 +1,150 @@
 """
-This module provides a script runner for a set of predefined scripts.
+This module runs the Gmail sorting scripts, all in this one process.
+
+  python runThis.py                  interactive menu
+  python runThis.py scan|tag|generate|apply [options]
+                                     one stage, with that script's options
+  python runThis.py all [--count N]  scan -> auto-tag -> generate, unattended
+
+Each stage imports its module only when it runs, so the offline stages never
+load the Google client libraries.
 """
 
 import os
-import subprocess
+import sys
+import argparse
+import importlib
+
+STAGES = {
+    "scan": {
+        "name": "Email Fix - Reads top 40,000 emails and indexes all "
+        "unique email addresses [Takes a long time]",
+        "module": "email_fix"
+    },
+    "tag": {
+        "name": "Tag All Emails - Manual Script to apply tags to each of "
+        "the unique email addresses so they\'re binned correctly",
+        "module": "tag_all_emails"
+    },
+    "generate": {
+        "name": "Generate Filter XMLs - Generates the XML file that can "
+        "be uploaded to Gmail to apply the filters",
+        "module": "generate_filter_xmls"
+    },
+    "apply": {
+        "name": "Apply Filters - Creates the generated filters in Gmail "
+        "and labels the emails you already have",
+        "module": "apply_filters"
+    }
+}
+TAGGED_FILE = "xmlupdate.txt"
 
 
 def select_script(scripts):
-  """Display script options and return the file of the selected script."""
-  for key, value in scripts.items():
-    print(f"{key}: {value["name"]}")
+  """Display script options and return the key of the selected script."""
+  choices = dict(zip(map(str, range(1, len(scripts) + 1)), scripts))
+  for number, key in choices.items():
+    print(f"{number}: {scripts[key]["name"]}")
 
   while True:
     choice = input("Enter the number of the script to run: ")
-    if choice in scripts:
-      return scripts[choice]["file"]
+    if choice in choices:
+      return choices[choice]
     print("Invalid choice. Please enter a valid number.")
 
 
-def run_script():
-  """Change directory to script location and run the selected script."""
-  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+def run_stage(stage, argv=()):
+  """Run one stage's script and return its exit status."""
+  module = importlib.import_module(STAGES[stage]["module"])
+  return module.main(list(argv))
+
+
+def run_pipeline(count=None, full=False, threshold=None):
+  """Scan, auto-tag and generate in one go, passing data along in memory.
+
+  The scan's aggregated senders feed the tagger directly, and the tags are
+  handed to the generator without re-reading sorted_emails.txt or
+  xmlupdate.txt. Returns an exit status.
+  """
+  import logging
+  import email_fix
+  import generate_filter_xmls
+  import scan_metrics
+  import sender_matcher
+  import tag_all_emails
 
-  scripts = {
-      "1": {
-          "name": "Email Fix - Reads top 40,000 emails and indexes all "
-          "unique email addresses [Takes a long time]",
-          "file": "email_fix.py"
-      },
-      "2": {
-          "name": "Tag All Emails - Manual Script to apply tags to each of "
-          "the unique email addresses so they\'re binned correctly",
-          "file": "tag_all_emails.py"
-      },
-      "3": {
-          "name": "Generate Filter XMLs - Generates the XML file that can "
-          "be uploaded to Gmail to apply the filters",
-          "file": "generate_filter_xmls.py"
-      }
-  }
-
-  script_to_run = select_script(scripts)
+  logging.basicConfig(filename="email_processing.log", level=logging.INFO,
+                      format="%(asctime)s - %(levelname)s - %(message)s")
+  xml_emails = email_fix.parse_xml_file(email_fix.XML_FILE)
+  incremental = email_fix.has_previous_scan() and not full
+  creds = email_fix.get_credentials()
+  if creds is None:
+    print("Failed to obtain credentials. Exiting.")
+    return 1
+  result = email_fix.scan_mailbox(
+      creds, count or email_fix.DEFAULT_COUNT, incremental, xml_emails,
+      scan_metrics.Metrics(scan_metrics.METRICS_FILE))
+  if result is None:
+    print("The scan failed; nothing was tagged or generated.")
+    return 1
+  unique_emails, email_subjects = result
+
+  if not os.path.exists(TAGGED_FILE):
+    open(TAGGED_FILE, "w", encoding="utf-8").close()
+  emails = generate_filter_xmls.get_emails_from_update_file(TAGGED_FILE)
+  if tag_all_emails.tag_suggester is None:
+    print("Install numpy to auto-tag senders. Skipping tagging.")
+  else:
+    suggester = tag_all_emails.tag_suggester.train(
+        None, TAGGED_FILE, email_fix.XML_FILE, email_subjects)
+    if suggester.labels:
+      excluded = sender_matcher.SenderMatcher(emails)
+      senders = tag_all_emails.untagged_records(unique_emails, email_subjects,
+                                                excluded)
+      accepted = tag_all_emails.accept_confident_suggestions(
+          tag_all_emails.tag_suggester.annotate(suggester, senders),
+          TAGGED_FILE, threshold, confirm=False)
+      for email, label in accepted.items():
+        emails.setdefault(email, []).append(label)
+
+  diff = generate_filter_xmls.process_email_updates(
+      TAGGED_FILE, email_fix.XML_FILE, "newMailFilters.xml", emails=emails)
+  return 0 if diff is not None else 1
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description="Run the Gmail sorting scripts.",
+      epilog="Options after a stage name are passed on to that stage's script.")
+  parser.add_argument("stage", nargs="?", choices=[*STAGES, "all"],
+                      help="stage to run; without one an interactive menu is shown")
+  parser.add_argument("options", nargs=argparse.REMAINDER,
+                      help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
   try:
-    subprocess.run(["python", os.path.join(
-        os.getcwd(), script_to_run)], check=False)
-  except subprocess.CalledProcessError as e:
-    print(f"Failed to run script: {e}")
+    if args.stage == "all":
+      pipeline = argparse.ArgumentParser(
+          prog="runThis.py all",
+          description="Scan, auto-tag with confident suggestions and generate "
+          "the filter XML, without any prompt.")
+      pipeline.add_argument("--count", type=int,
+                            help="emails a full scan reads")
+      pipeline.add_argument("--full", action="store_true",
+                            help="run a full scan even if an incremental sync "
+                            "is possible")
+      pipeline.add_argument("--threshold", type=float,
+                            help="least confidence for a suggestion to be applied")
+      options = pipeline.parse_args(args.options)
+      return run_pipeline(options.count, options.full, options.threshold)
+    if args.stage:
+      return run_stage(args.stage, args.options)
+    return run_stage(select_script(STAGES))
   except KeyboardInterrupt:
     print("Script runner terminated.")
+    return 1
 
 
 if __name__ == "__main__":
-  run_script()
+  sys.exit(main())
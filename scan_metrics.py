@@ -0,0 +1,183 @@
+import os
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+METRICS_FILE = "scan_metrics.jsonl"  # Periodic JSON snapshots of a scan
+PROMETHEUS_FILE = "scan_metrics.prom"  # Prometheus textfile-collector output
+EXPORT_INTERVAL = 10  # Seconds between exported snapshots
+EWMA_ALPHA = 0.3  # Weight of the newest throughput sample
+EWMA_SAMPLE = 1.0  # Minimum seconds between throughput samples
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)  # Seconds
+STAGES = ("list", "get", "parse", "aggregate", "write", "quota_wait")
+COUNTERS = ("messages", "cached", "quota_units", "retries", "rate_limited",
+            "errors")
+
+
+class Histogram:
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    for i, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[i] += 1
+        break
+    self.sum += value
+    self.count += 1
+
+  def cumulative(self):
+    """(upper bound, observations at or below it) pairs, as Prometheus wants."""
+    running = 0
+    for bound, count in zip(self.buckets, self.counts):
+      running += count
+      yield bound, running
+
+
+class Metrics:
+  """Thread-safe stage timers, API latency histograms, counters and an
+  EWMA throughput/ETA for one scan, exported as JSON lines or in the
+  Prometheus text format.
+
+  Stage times are summed over all threads, so with several fetch workers
+  "get" can exceed the wall-clock time of the scan.
+  """
+
+  def __init__(self, export_file=None, export_format="jsonl",
+               interval=EXPORT_INTERVAL):
+    self.export_file = export_file
+    self.export_format = export_format
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.started = time.perf_counter()
+    self.stages = {stage: [0.0, 0] for stage in STAGES}  # [seconds, count]
+    self.counters = dict.fromkeys(COUNTERS, 0)
+    self.latency = {}
+    self.total = None
+    self.rate = None
+    self.sample = (self.started, 0)  # (time, messages) of the last EWMA sample
+    self.last_export = self.started
+
+  # Recording
+
+  def add_time(self, stage, seconds, count=1):
+    with self.lock:
+      totals = self.stages.setdefault(stage, [0.0, 0])
+      totals[0] += seconds
+      totals[1] += count
+
+  @contextmanager
+  def timer(self, stage):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add_time(stage, time.perf_counter() - start)
+
+  def observe(self, method, seconds):
+    """Record the latency of one API round trip."""
+    with self.lock:
+      if method not in self.latency:
+        self.latency[method] = Histogram()
+      self.latency[method].observe(seconds)
+
+  def increment(self, counter, value=1):
+    with self.lock:
+      self.counters[counter] = self.counters.get(counter, 0) + value
+
+  def progress(self, messages):
+    """Count `messages` more processed messages and update the throughput."""
+    now = time.perf_counter()
+    with self.lock:
+      self.counters["messages"] += messages
+      sampled_at, sampled = self.sample
+      if now - sampled_at >= EWMA_SAMPLE:
+        current = (self.counters["messages"] - sampled) / (now - sampled_at)
+        self.rate = current if self.rate is None else \
+            EWMA_ALPHA * current + (1 - EWMA_ALPHA) * self.rate
+        self.sample = (now, self.counters["messages"])
+    if self.export_file and now - self.last_export >= self.interval:
+      self.export()
+
+  def eta(self):
+    """Seconds left at the smoothed throughput, or None if unknown."""
+    if not self.total or not self.rate:
+      return None
+    return max(0.0, (self.total - self.counters["messages"]) / self.rate)
+
+  # Export
+
+  def snapshot(self):
+    with self.lock:
+      return {
+          "time": time.time(),
+          "elapsed": round(time.perf_counter() - self.started, 3),
+          "total": self.total,
+          "rate": round(self.rate, 2) if self.rate else None,
+          "eta": round(self.eta(), 1) if self.eta() is not None else None,
+          "stages": {stage: {"seconds": round(seconds, 4), "count": count}
+                     for stage, (seconds, count) in self.stages.items()},
+          "counters": dict(self.counters),
+          "latency": {method: {
+              "count": histogram.count, "sum": round(histogram.sum, 4),
+              "buckets": {("+Inf" if math.isinf(bound) else str(bound)): count
+                          for bound, count in histogram.cumulative()}}
+              for method, histogram in self.latency.items()},
+      }
+
+  def prometheus(self):
+    """Render the current metrics in the Prometheus text exposition format."""
+    snapshot = self.snapshot()
+    lines = ["# TYPE gmail_sorting_stage_seconds_total counter"]
+    for stage, totals in snapshot["stages"].items():
+      lines.append(f'gmail_sorting_stage_seconds_total{{stage="{stage}"}} '
+                   f'{totals["seconds"]}')
+    for counter, value in snapshot["counters"].items():
+      lines.append(f"# TYPE gmail_sorting_{counter}_total counter")
+      lines.append(f"gmail_sorting_{counter}_total {value}")
+    lines.append("# TYPE gmail_sorting_api_latency_seconds histogram")
+    for method, histogram in snapshot["latency"].items():
+      for bound, count in histogram["buckets"].items():
+        lines.append(f'gmail_sorting_api_latency_seconds_bucket'
+                     f'{{method="{method}",le="{bound}"}} {count}')
+      lines.append(f'gmail_sorting_api_latency_seconds_sum{{method="{method}"}} '
+                   f'{histogram["sum"]}')
+      lines.append(f'gmail_sorting_api_latency_seconds_count{{method="{method}"}} '
+                   f'{histogram["count"]}')
+    for gauge in ("total", "rate", "eta"):
+      if snapshot[gauge] is not None:
+        lines.append(f"# TYPE gmail_sorting_{gauge} gauge")
+        lines.append(f"gmail_sorting_{gauge} {snapshot[gauge]}")
+    return "\n".join(lines) + "\n"
+
+  def export(self):
+    """Append a JSON snapshot, or atomically rewrite the Prometheus file."""
+    self.last_export = time.perf_counter()
+    if not self.export_file:
+      return
+    if self.export_format == "prometheus":
+      temp_file = self.export_file + ".tmp"
+      with open(temp_file, "w", encoding="utf-8") as f:
+        f.write(self.prometheus())
+      os.replace(temp_file, self.export_file)
+    else:
+      with open(self.export_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(self.snapshot()) + "\n")
+
+  def summary(self):
+    """One line per stage with its share of the total stage time."""
+    snapshot = self.snapshot()
+    spent = sum(totals["seconds"] for totals in snapshot["stages"].values()) or 1
+    lines = [f"{stage:>10}: {totals['seconds']:9.2f}s "
+             f"({100 * totals['seconds'] / spent:4.1f}%)"
+             for stage, totals in snapshot["stages"].items() if totals["count"]]
+    counters = snapshot["counters"]
+    lines.append(f"Quota units: {counters['quota_units']}, 429s: "
+                 f"{counters['rate_limited']}, retries: {counters['retries']}, "
+                 f"errors: {counters['errors']}")
+    return "\n".join(lines)
@@ -0,0 +1,121 @@
+import json
+
+INDEX_FILE = "sender_index.jsonl"  # One JSON record per sender, by frequency
+INDEX_VERSION = 1
+
+
+def write_sender_index(index_file, unique_emails, email_subjects,
+                       account_counts=None):
+  """Write the sender index, most frequent sender first.
+
+  The first line is a header ({"version", "senders", "messages"}) so readers
+  can report totals without scanning the file; every other line is one
+  {"email", "count", "subjects"} record. A combined index of several
+  accounts also lists them in the header and carries an {account: count}
+  "accounts" field per record.
+  """
+  senders = sorted(unique_emails.items(), key=lambda item: item[1],
+                   reverse=True)
+  with open(index_file, "w", encoding="utf-8") as f:
+    header = {"version": INDEX_VERSION, "senders": len(senders),
+              "messages": sum(unique_emails.values())}
+    if account_counts is not None:
+      header["accounts"] = sorted({account for counts in account_counts.values()
+                                   for account in counts})
+    f.write(json.dumps(header) + "\n")
+    for email, count in senders:
+      record = {"email": email, "count": count,
+                "subjects": email_subjects.get(email, [])}
+      if account_counts is not None:
+        record["accounts"] = account_counts.get(email, {})
+      f.write(json.dumps(record, ensure_ascii=False,
+                         separators=(",", ":")) + "\n")
+
+
+def read_header(index_file):
+  with open(index_file, "r", encoding="utf-8") as f:
+    return json.loads(f.readline() or "{}")
+
+
+def iter_sender_index(index_file):
+  """Stream {"email", "count", "subjects"} records without loading the file."""
+  with open(index_file, "r", encoding="utf-8") as f:
+    f.readline()  # Header
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+
+def load_sender_index(index_file):
+  """Read the whole index back as (unique_emails, email_subjects) dicts."""
+  unique_emails = {}
+  email_subjects = {}
+  for record in iter_sender_index(index_file):
+    unique_emails[record["email"]] = record["count"]
+    email_subjects[record["email"]] = record["subjects"]
+  return unique_emails, email_subjects
+
+
+def merge_sender_indexes(index_files):
+  """Combine the sender indexes of several accounts.
+
+  index_files maps account names to index files. Returns (unique_emails,
+  email_subjects, account_counts) with total counts, up to two subjects per
+  sender and {email: {account: count}}.
+  """
+  unique_emails = {}
+  email_subjects = {}
+  account_counts = {}
+  for account, index_file in index_files.items():
+    for record in iter_sender_index(index_file):
+      email = record["email"]
+      unique_emails[email] = unique_emails.get(email, 0) + record["count"]
+      subjects = email_subjects.setdefault(email, [])
+      subjects.extend(record["subjects"][:2 - len(subjects)])
+      account_counts.setdefault(email, {})[account] = record["count"]
+  return unique_emails, email_subjects, account_counts
+
+
+def write_text_report(f, unique_emails, email_subjects, account_counts=None):
+  """Write the human-readable sorted_emails.txt view of the index.
+
+  With account_counts, a combined report also gets per-account totals and
+  per-account counts in the alphabetical section.
+  """
+  unique_emails_alphabetical = sorted(unique_emails.items())
+  unique_emails_count = sorted(
+      unique_emails.items(), key=lambda item: item[1], reverse=True)
+
+  if account_counts is not None:
+    totals = {}
+    for counts in account_counts.values():
+      for account, count in counts.items():
+        messages, senders = totals.get(account, (0, 0))
+        totals[account] = (messages + count, senders + 1)
+    f.write("-----------------------------\n")
+    f.write("BY ACCOUNT\n")
+    for account, (messages, senders) in sorted(totals.items()):
+      f.write(f"{account}: {messages} emails from {senders} senders\n")
+    f.write(f"Total: {sum(unique_emails.values())} emails from "
+            f"{len(unique_emails)} senders\n")
+
+  f.write("-----------------------------\n")
+  f.write("BY ALPHABETICAL\n")
+  for email, count in unique_emails_alphabetical:
+    subjects = " | ".join(
+        email_subjects.get(email) or ["No Subject"])
+    if account_counts is not None:
+      accounts = ", ".join(f"{account} {n}" for account, n
+                           in sorted(account_counts.get(email, {}).items()))
+      f.write(f"{email} || {count} || Subjects: {subjects} || Accounts: {accounts}\n")
+    else:
+      f.write(f"{email} || {count} || Subjects: {subjects}\n")
+
+  f.write("-----------------------------\n")
+  f.write("BY FREQUENCY\n")
+  for email, count in unique_emails_count:
+    subjects = " | ".join(
+        email_subjects.get(email) or ["No Subject"])
+    f.write(f"{email} || {count} || Subjects: {subjects}\n")
+
+  f.write("-----------------------------\n")
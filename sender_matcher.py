@@ -0,0 +1,133 @@
+import re
+import xml.etree.ElementTree as ET
+
+APPS_NS = {"apps": "http://schemas.google.com/apps/2006"}
+QUERY_CHUNK_TERMS = 25  # Senders per -from:(...) group of a search query
+MAX_QUERY_LENGTH = 1500  # Characters of a search query spent on excluded senders
+QUERY_UNSAFE = re.compile(r'[\s(){}"]')  # Would break out of a from:(...) group
+
+
+def split_criteria(value):
+  """Split a Gmail `from` criterion into its individual sender terms.
+
+  Handles "a OR b", "a | b", "{a b}" and "(a OR b)" forms as exported in
+  mailFilters.xml.
+  """
+  value = value.strip()
+  if value.startswith("{") and value.endswith("}"):
+    return [term for term in value[1:-1].split() if term]
+  value = value.strip("()")
+  return [term.strip().strip('"()') for term in re.split(r"\s+OR\s+|\s*\|\s*", value)
+          if term.strip().strip('"()')]
+
+
+def normalize_term(term):
+  """Classify a sender term as ("exact", address), ("at_domain", domain) or
+  ("domain", domain).
+
+  "@x" and "*@x" match like Gmail's from:@x, as a suffix of the address, so
+  they cover x itself but not its subdomains; a bare "x" covers both. Returns
+  None for terms that are not addresses or domains (e.g. display
+  names), since those cannot be matched against a bare address.
+  """
+  email_match = re.search(r"<(.+)>", term)
+  term = (email_match.group(1) if email_match else term).strip().lower()
+  if term.startswith("*@") or term.startswith("@"):
+    domain = term.split("@", 1)[1].lstrip("*.")
+    return ("at_domain", domain) if domain else None
+  if "@" in term:
+    return "exact", term
+  if "." in term and " " not in term:
+    return "domain", term.lstrip("*.")
+  return None
+
+
+class SenderMatcher:
+  """Answers "is this sender already covered by a filter?" in O(domain depth).
+
+  Exact addresses, "@domain" rules and bare domain rules each live in a
+  hashed set. A lookup checks the address, its domain, then each suffix of
+  the domain, so a rule for "riotgames.com" covers
+  "LeagueofLegends@em.riotgames.com" while "@riotgames.com" does not, the
+  same as in a Gmail filter. Supports `in`, so it can stand in for the set
+  of filtered addresses.
+  """
+
+  def __init__(self, terms=()):
+    self.exact = set()
+    self.at_domains = set()
+    self.domains = set()
+    for term in terms:
+      self.add(term)
+
+  def add(self, term):
+    normalized = normalize_term(term)
+    if normalized is None:
+      return False
+    kind, value = normalized
+    {"exact": self.exact, "at_domain": self.at_domains,
+     "domain": self.domains}[kind].add(value)
+    return True
+
+  def matches(self, email):
+    email = email.lower()
+    if email in self.exact:
+      return True
+    domain = email.rpartition("@")[2]
+    if domain in self.at_domains:
+      return True
+    while domain:
+      if domain in self.domains:
+        return True
+      domain = domain.partition(".")[2]
+    return False
+
+  __contains__ = matches
+
+  def __len__(self):
+    return len(self.exact) + len(self.at_domains) + len(self.domains)
+
+  def exclusion_query(self, max_length=MAX_QUERY_LENGTH,
+                      chunk_terms=QUERY_CHUNK_TERMS):
+    """Compile the rules into Gmail search terms that exclude their senders.
+
+    Returns (query, excluded): `-from:(a OR b ...)` groups of at most
+    chunk_terms senders, and how many rules they cover. Domain rules go first
+    since each covers many senders; rules that would take the query past
+    max_length characters are left out and still have to be matched
+    client-side.
+    """
+    terms = [term for term in [*sorted(self.domains),
+                               *("@" + domain for domain in sorted(self.at_domains)),
+                               *sorted(self.exact)]
+             if not QUERY_UNSAFE.search(term)]
+    groups = []
+    length = 0
+    excluded = 0
+    while excluded < len(terms):
+      chunk = terms[excluded:excluded + chunk_terms]
+      group = f"-from:({' OR '.join(chunk)})"
+      # Shrink the last group to whatever still fits
+      while chunk and length + len(group) + 1 > max_length:
+        chunk.pop()
+        group = f"-from:({' OR '.join(chunk)})"
+      if not chunk:
+        break
+      groups.append(group)
+      length += len(group) + 1
+      excluded += len(chunk)
+    return " ".join(groups), excluded
+
+
+def iter_filter_senders(xml_file):
+  """Yield every sender term of the `from` criteria in a mailFilters.xml."""
+  root = ET.parse(xml_file).getroot()
+  for prop in root.iterfind('.//apps:property[@name="from"]', APPS_NS):
+    value = prop.get("value")
+    if value:
+      yield from split_criteria(value)
+
+
+def load_filter_matcher(xml_file):
+  """Build a SenderMatcher from the filters in xml_file."""
+  return SenderMatcher(iter_filter_senders(xml_file))
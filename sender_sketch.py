@@ -0,0 +1,130 @@
+import math
+import heapq
+import random
+from array import array
+
+TRACKED_SENDERS = 10000  # Senders the Space-Saving summary keeps exact-ish counts for
+SKETCH_EPSILON = 0.0001  # Count-Min overestimates by at most epsilon * messages...
+SKETCH_DELTA = 0.001  # ...except with probability delta
+SUBJECT_SAMPLES = 2  # Subjects kept per tracked sender
+
+
+class CountMinSketch:
+  """Approximate counts in fixed memory; estimates never undercount."""
+
+  def __init__(self, epsilon=SKETCH_EPSILON, delta=SKETCH_DELTA):
+    self.epsilon = epsilon
+    self.width = math.ceil(math.e / epsilon)
+    self.depth = math.ceil(math.log(1 / delta))
+    self.rows = [array("Q", bytes(8 * self.width)) for _ in range(self.depth)]
+
+  def _columns(self, key):
+    # Double hashing gives `depth` independent enough columns from two hashes
+    first, second = hash(key), hash((key, "count-min")) | 1
+    return [(first + i * second) % self.width for i in range(self.depth)]
+
+  def add(self, key, count=1):
+    for row, column in zip(self.rows, self._columns(key)):
+      row[column] += count
+
+  def estimate(self, key):
+    return min(row[column] for row, column in zip(self.rows, self._columns(key)))
+
+
+class SpaceSaving:
+  """Space-Saving heavy hitters: tracks at most `capacity` keys.
+
+  Every key seen more than messages / capacity times is tracked, and a
+  tracked key's count overestimates its true count by at most its `error`.
+  """
+
+  def __init__(self, capacity=TRACKED_SENDERS):
+    self.capacity = capacity
+    self.counts = {}  # key -> [count, error]
+    self.heap = []  # (count, key) entries, stale ones skipped when popping
+
+  def add(self, key, count=1):
+    """Count `key`; returns the key it evicted, if any."""
+    evicted = None
+    entry = self.counts.get(key)
+    if entry is None:
+      if len(self.counts) < self.capacity:
+        entry = self.counts[key] = [0, 0]
+      else:
+        evicted, floor = self._pop_min()
+        entry = self.counts[key] = [floor, floor]
+    entry[0] += count
+    heapq.heappush(self.heap, (entry[0], key))
+    if len(self.heap) > 4 * self.capacity:
+      # Drop stale entries so the heap stays proportional to capacity
+      self.heap = [(count, key) for key, (count, _) in self.counts.items()]
+      heapq.heapify(self.heap)
+    return evicted
+
+  def _pop_min(self):
+    while True:
+      count, key = heapq.heappop(self.heap)
+      entry = self.counts.get(key)
+      if entry is not None and entry[0] == count:
+        del self.counts[key]
+        return key, count
+
+  def top(self):
+    """(key, count, error) triples, highest count first."""
+    return sorted(((key, count, error) for key, (count, error)
+                   in self.counts.items()), key=lambda item: item[1],
+                  reverse=True)
+
+
+class SenderSketch:
+  """Bounded-memory replacement for the exact per-sender dicts.
+
+  Heavy hitters come from Space-Saving, their counts are tightened with a
+  Count-Min sketch, and each tracked sender keeps a reservoir sample of its
+  subjects. Memory depends only on the parameters, not on the mailbox.
+  """
+
+  def __init__(self, capacity=TRACKED_SENDERS, epsilon=SKETCH_EPSILON,
+               delta=SKETCH_DELTA, samples=SUBJECT_SAMPLES, seed=None):
+    self.heavy_hitters = SpaceSaving(capacity)
+    self.sketch = CountMinSketch(epsilon, delta)
+    self.samples = samples
+    self.subjects = {}  # key -> [subjects seen while tracked, reservoir]
+    self.messages = 0
+    self.rng = random.Random(seed)
+
+  def add(self, email, subject=None, count=1):
+    self.messages += count
+    self.sketch.add(email, count)
+    evicted = self.heavy_hitters.add(email, count)
+    if evicted is not None:
+      self.subjects.pop(evicted, None)
+    if subject is not None:
+      self.add_subject(email, subject)
+
+  def add_subject(self, email, subject):
+    """Reservoir-sample a subject of a tracked sender."""
+    if email not in self.heavy_hitters.counts:
+      return
+    entry = self.subjects.setdefault(email, [0, []])
+    entry[0] += 1
+    if len(entry[1]) < self.samples:
+      entry[1].append(subject)
+    else:
+      slot = self.rng.randrange(entry[0])
+      if slot < self.samples:
+        entry[1][slot] = subject
+
+  def top(self):
+    """Return (unique_emails, email_subjects) for the tracked senders."""
+    unique_emails = {}
+    email_subjects = {}
+    for email, count, _ in self.heavy_hitters.top():
+      unique_emails[email] = min(count, self.sketch.estimate(email))
+      email_subjects[email] = self.subjects.get(email, [0, []])[1]
+    return unique_emails, email_subjects
+
+  def error_bound(self):
+    """Most any reported count can exceed the true count by."""
+    return min(self.messages / self.heavy_hitters.capacity,
+               self.sketch.epsilon * self.messages)
@@ -1,10 +1,49 @@
 import os
 import re
+import sys
+import argparse
 import xml.etree.ElementTree as ET
+import sender_matcher
+import sender_index
+
+try:
+  import tag_suggester
+except ImportError:  # numpy is only needed for suggestions
+  tag_suggester = None
+
+GROUP_PREVIEW = 5  # Member addresses shown per group
+SUBJECT_PATTERN_WORDS = 4  # Leading subject words that make up a subject pattern
+# Shared mailbox providers never make a meaningful domain rule
+FREEMAIL_DOMAINS = frozenset((
+    "gmail.com", "googlemail.com", "yahoo.com", "yahoo.ca", "hotmail.com",
+    "outlook.com", "live.com", "msn.com", "icloud.com", "me.com", "aol.com",
+    "protonmail.com", "proton.me", "gmx.com"))
+# Labels that sit under a country code TLD, as in co.uk or com.au
+SECOND_LEVEL_LABELS = frozenset(("co", "com", "org", "net", "gov", "ac", "edu"))
+
+
+def load_exclusions(tagged_filename, filters_filename=None):
+  """Return a SenderMatcher for senders already tagged or filtered."""
+  excluded = sender_matcher.SenderMatcher()
+  with open(tagged_filename, "r", encoding="utf-8") as f:
+    for line in f:
+      excluded.add(line.split(": ")[0])
+
+  if filters_filename and os.path.exists(filters_filename):
+    try:
+      for term in sender_matcher.iter_filter_senders(filters_filename):
+        excluded.add(term)
+    except ET.ParseError:
+      print(f"Error reading XML file {filters_filename}.")
+  return excluded
+
 
+def get_emails(filename, tagged_filename, filters_filename=None):
+  """Extract emails from the given files.
 
-def get_emails(filename, tagged_filename):
-  """Extract emails from the given files."""
+  Senders already tagged in tagged_filename, or covered by a filter in
+  filters_filename, are left out.
+  """
   emails = []
   if os.path.getsize(filename) != 0:
     try:
@@ -18,13 +57,43 @@ def get_emails(filename, tagged_filename):
               for line in lines[start_index:] if " || " in line]
 
   try:
-    with open(tagged_filename, "r", encoding="utf-8") as f:
-      tagged_emails = [line.split(": ")[0] for line in f.readlines()]
+    excluded = load_exclusions(tagged_filename, filters_filename)
   except FileNotFoundError:
     print(f"File {tagged_filename} not found.")
     return []
 
-  return [email for email in emails if email not in tagged_emails]
+  return [email for email in emails if email not in excluded]
+
+
+def iter_untagged_senders(index_file, tagged_filename, filters_filename=None):
+  """Stream sender index records that still need a tag."""
+  excluded = load_exclusions(tagged_filename, filters_filename)
+  for rank, record in enumerate(sender_index.iter_sender_index(index_file),
+                                start=1):
+    if record["email"] not in excluded:
+      record["rank"] = rank  # Position in the index, for progress reporting
+      yield record
+
+
+def untagged_records(unique_emails, email_subjects, excluded):
+  """Records for the untagged senders of an in-memory index, most frequent
+  first, as iter_untagged_senders would read them back from the file.
+  """
+  senders = sorted(unique_emails.items(), key=lambda item: item[1],
+                   reverse=True)
+  for rank, (email, count) in enumerate(senders, start=1):
+    if email not in excluded:
+      yield {"email": email, "count": count,
+             "subjects": email_subjects.get(email, []), "rank": rank}
+
+
+def iter_text_report(filename, tagged_filename, filters_filename=None):
+  """Records for untagged senders, read from the sorted_emails.txt report."""
+  emails = get_emails(filename, tagged_filename, filters_filename)
+  subjects, frequencies = extract_subjects(filename)
+  for email in emails:
+    yield {"email": email, "count": frequencies.get(email, "N/A"),
+           "subjects": subjects.get(email, [])}
 
 
 def get_labels(filename, tagged_filename, labels_filename):
@@ -128,39 +197,70 @@ def extract_subjects(filename):
   return subjects, frequencies
 
 
-def tag_emails(emails, labels, tagged_filename, subjects, frequencies):
-  """Tag emails with the given labels."""
+def choose_label(labels, suggestions=(), target="email"):
+  """Prompt for one of `labels` (or a suggestion, or a new label).
+
+  Returns the chosen label, or None when the user skips.
+  """
+  letters = list("abcdefghijklm"[:len(suggestions)])  # One letter each
+  if suggestions:
+    print("Suggested: " + "   ".join(
+        f"{letter}. {label} ({probability:.0%})"
+        for letter, (label, probability) in zip(letters, suggestions)))
+
+  labels.sort()
+  print_labels_in_columns(labels, num_columns=3)
+  print("0. Define a new label")
+
+  while True:
+    response = input(
+        f'Choose a number to tag this {target}, a letter to take a suggestion or "n" to skip: '
+        if suggestions else f'Choose a number to tag this {target} or "n" to skip: ')
+    if response == "n" or response in letters or \
+            (response.isdigit() and 0 <= int(response) <= len(labels)):
+      break
+    else:
+      print(f"Invalid input. Please enter a number between 0 and {
+            len(labels)} or 'n' to skip.")
+
+  if response in letters:
+    label = suggestions[letters.index(response)][0]
+    if label not in labels:
+      labels.append(label)
+    return label
+  if response.isdigit():
+    if int(response) == 0:
+      new_label = input("Enter the new label: ")
+      labels.append(new_label)
+      return new_label
+    return labels[int(response) - 1]
+  return None
+
+
+def tag_emails(senders, labels, tagged_filename, total=None):
+  """Tag emails with the given labels.
+
+  senders is an iterable of {"email", "count", "subjects"} records and is
+  consumed lazily, one prompt at a time.
+  """
   tagged_emails = {}
-  for i, email in enumerate(emails, start=1):
-    email_subjects = subjects.get(email, [])
-    email_freq = frequencies.get(email, "N/A")
+  for i, sender in enumerate(senders, start=1):
+    email = sender["email"]
+    email_subjects = sender.get("subjects") or []
+    email_freq = sender.get("count", "N/A")
     subject_example = "\nSubjects:\n - " + \
         "\n - ".join(email_subjects) if email_subjects else ""
+    position = sender.get("rank", i)
+    remaining = f"\n({total - position} email addresses remaining)" if total else ""
     print(f"\nTagging email: {email} (FREQ: {email_freq}){
-          subject_example}\n({len(emails) - i} email addresses remaining)")
+          subject_example}{remaining}")
 
-    labels.sort()
-    print_labels_in_columns(labels, num_columns=3)
-    print("0. Define a new label")
-
-    while True:
-      response = input(
-          'Choose a number to tag this email or "n" to skip: ')
-      if response == "n" or (response.isdigit() and 0 <= int(response) <= len(labels)):
-        break
-      else:
-        print(f"Invalid input. Please enter a number between 0 and {
-              len(labels)} or 'n' to skip.")
-
-    if response.isdigit() and int(response) <= len(labels):
-      if int(response) == 0:
-        new_label = input("Enter the new label: ")
-        labels.append(new_label)
-        response = str(len(labels))
+    label = choose_label(labels, sender.get("suggestions") or [])
+    if label is not None:
       if email in tagged_emails:
-        tagged_emails[email].append(labels[int(response) - 1])
+        tagged_emails[email].append(label)
       else:
-        tagged_emails[email] = [labels[int(response) - 1]]
+        tagged_emails[email] = [label]
 
       try:
         with open(tagged_filename, "a", encoding="utf-8") as f:
@@ -171,36 +271,196 @@ def tag_emails(emails, labels, tagged_filename, subjects, frequencies):
         print(f"An IOError occurred: {e}")
 
 
-def main():
+def registrable_domain(email):
+  """Best-effort registrable domain: em.riotgames.com -> riotgames.com."""
+  parts = email.lower().rpartition("@")[2].split(".")
+  if len(parts) >= 3 and len(parts[-1]) == 2 and parts[-2] in SECOND_LEVEL_LABELS:
+    return ".".join(parts[-3:])
+  return ".".join(parts[-2:])
+
+
+def subject_pattern(subject):
+  """Lowercased leading words of a subject with numbers masked out."""
+  words = re.findall(r"[\w#]+", re.sub(r"\d+", "#", subject.lower()))
+  return " ".join(words[:SUBJECT_PATTERN_WORDS])
+
+
+def group_senders(senders, by="domain"):
+  """Cluster sender records by registrable domain or by subject pattern.
+
+  Returns groups ({"key", "domain", "senders", "count"}) by total frequency.
+  Senders on shared mail providers, or without a usable subject, get a
+  group of their own.
+  """
+  groups = {}
+  for sender in senders:
+    domain = None
+    if by == "subject":
+      subjects = sender.get("subjects") or []
+      key = subject_pattern(subjects[0]) if subjects else ""
+      if not key or key == "no subject":
+        key = sender["email"]
+    else:
+      key = domain = registrable_domain(sender["email"])
+      if domain in FREEMAIL_DOMAINS:
+        key, domain = sender["email"], None
+    group = groups.setdefault(key, {"key": key, "domain": domain,
+                                    "senders": [], "count": 0})
+    group["senders"].append(sender)
+    count = sender.get("count")
+    group["count"] += int(count) if str(count).isdigit() else 0
+  return sorted(groups.values(), key=lambda group: group["count"], reverse=True)
+
+
+def tag_groups(groups, labels, tagged_filename, domain_rules=True):
+  """Tag whole groups of senders with a single choice each.
+
+  Domain groups are written as one bare "domain: label" rule, which covers
+  the domain's subdomains too, when domain_rules is set, and as one line per
+  address otherwise.
+  """
+  for i, group in enumerate(groups, start=1):
+    senders = group["senders"]
+    print(f"\nTagging group: {group['key']} ({len(senders)} email addresses, "
+          f"FREQ: {group['count']})")
+    for sender in senders[:GROUP_PREVIEW]:
+      print(f" - {sender['email']} ({sender.get('count', 'N/A')})")
+    if len(senders) > GROUP_PREVIEW:
+      print(f" ... and {len(senders) - GROUP_PREVIEW} more")
+    samples = [sender["subjects"][0] for sender in senders[:3]
+               if sender.get("subjects")]
+    if samples:
+      print("Subjects:\n - " + "\n - ".join(samples))
+    print(f"({len(groups) - i} groups remaining)")
+
+    label = choose_label(labels, target="group")
+    if label is None:
+      continue
+
+    if domain_rules and group["domain"] and len(senders) > 1:
+      lines = [f"{group['domain']}: {label}"]
+    else:
+      lines = [f"{sender['email']}: {label}" for sender in senders]
+    try:
+      with open(tagged_filename, "a", encoding="utf-8") as f:
+        f.write("".join(line + "\n" for line in lines))
+    except IOError as e:
+      print(f"An IOError occurred: {e}")
+
+
+def accept_confident_suggestions(senders, tagged_filename,
+                                 threshold=None, confirm=True):
+  """Offer to tag, in one go, every sender whose top suggestion is at least
+  `threshold` likely. `senders` must already carry "suggestions".
+
+  Returns the {email: label} assignments written; with confirm unset they
+  are accepted without asking.
+  """
+  threshold = threshold or tag_suggester.CONFIDENCE_THRESHOLD
+  confident = [(sender["email"], sender["suggestions"][0])
+               for sender in senders
+               if sender["suggestions"] and sender["suggestions"][0][1] >= threshold]
+  if not confident:
+    return {}
+
+  print(f"\n{len(confident)} email addresses have a suggestion with at "
+        f"least {threshold:.0%} confidence, for example:")
+  for email, (label, probability) in confident[:10]:
+    print(f" - {email} -> {label} ({probability:.0%})")
+  if confirm and input("Accept all of them? (y/n): ").strip().lower() != "y":
+    return {}
+
+  try:
+    with open(tagged_filename, "a", encoding="utf-8") as f:
+      for email, (label, _) in confident:
+        f.write(f"{email}: {label}\n")
+  except IOError as e:
+    print(f"An IOError occurred: {e}")
+    return {}
+  print(f"Tagged {len(confident)} email addresses.")
+  return {email: label for email, (label, _) in confident}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Tag the indexed senders.")
+  parser.add_argument("--auto", action="store_true",
+                      help="only tag the senders with a confident suggestion, "
+                      "without asking, then exit")
+  parser.add_argument("--group", choices=["domain", "subject"],
+                      help="tag whole groups of senders at once")
+  parser.add_argument("--per-address", action="store_true",
+                      help="write one line per address for domain groups "
+                      "instead of a single domain rule")
+  args = parser.parse_args(argv)
+
   script_dir = os.path.dirname(os.path.realpath(__file__))
   os.chdir(script_dir)
 
   xmlupdate_file = os.path.join(script_dir, "xmlupdate.txt")
   labels_file = os.path.join(script_dir, "labels.txt")
   output_file = os.path.join(script_dir, "sorted_emails.txt")
+  index_file = os.path.join(script_dir, sender_index.INDEX_FILE)
 
-  if not os.path.exists(output_file):
+  if not os.path.exists(index_file) and not os.path.exists(output_file):
     print(
         f"File {output_file} not found. Please provide the sorted_emails.txt file.")
-    return
+    return 1
 
   for file in [xmlupdate_file, labels_file]:
     if not os.path.exists(file) or os.path.getsize(file) == 0:
       with open(file, "w", encoding="utf-8") as f:
         pass
 
-  emails = get_emails(output_file, xmlupdate_file)
-  if not emails:
-    print("No emails to process.")
-    return
-
   labels = get_labels("mailFilters.xml", xmlupdate_file, labels_file)
-  subjects, frequencies = extract_subjects(output_file)
-  tag_emails(emails, labels, xmlupdate_file, subjects, frequencies)
+
+  def untagged_senders():
+    if os.path.exists(index_file):
+      return iter_untagged_senders(index_file, xmlupdate_file,
+                                   "mailFilters.xml")
+    return iter_text_report(output_file, xmlupdate_file, "mailFilters.xml")
+
+  suggester = None
+  if tag_suggester is None:
+    print("Install numpy to get label suggestions.")
+  else:
+    suggester = tag_suggester.train(index_file, xmlupdate_file,
+                                    "mailFilters.xml")
+    if suggester.labels:
+      accept_confident_suggestions(
+          tag_suggester.annotate(suggester, untagged_senders()),
+          xmlupdate_file, confirm=not args.auto)
+    else:
+      suggester = None
+  if args.auto:
+    return 0
+
+  if os.path.exists(index_file):
+    total = sender_index.read_header(index_file).get("senders")
+  else:
+    emails = get_emails(output_file, xmlupdate_file, "mailFilters.xml")
+    if not emails:
+      print("No emails to process.")
+      return 0
+    total = len(emails)
+
+  if args.group:
+    groups = group_senders(untagged_senders(), by=args.group)
+    tag_groups(groups, labels, xmlupdate_file,
+               domain_rules=not args.per_address)
+    print("No more groups to process.")
+    return 0
+
+  senders = untagged_senders()
+  if suggester is not None:
+    senders = tag_suggester.annotate(suggester, senders)
+  tag_emails(senders, labels, xmlupdate_file, total)
+  print("No more emails to process.")
+  return 0
 
 
 if __name__ == "__main__":
   try:
-    main()
+    sys.exit(main())
   except KeyboardInterrupt:
     print("\nEmail Tagger Script Terminated.")
+    sys.exit(1)
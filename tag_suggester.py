@@ -0,0 +1,184 @@
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+
+import sender_index
+import sender_matcher
+
+CONFIDENCE_THRESHOLD = 0.9  # Suggestions at least this likely can be bulk accepted
+TOP_K = 3  # Number of ranked suggestions shown per sender
+SCORE_CHUNK = 10000  # Senders scored per vectorized pass
+SMOOTHING = 1.0  # Additive (Laplace) smoothing for per-label token distributions
+STOP_WORDS = frozenset((
+    "the", "and", "for", "you", "your", "with", "are", "this", "that", "from",
+    "our", "new", "have", "has", "was", "will", "all", "not", "can", "get",
+    "now", "here", "just", "about", "more", "out", "what", "how", "who",
+    # Local parts shared by every kind of automated sender
+    "noreply", "reply", "donotreply", "no", "do", "not", "mail", "email",
+    "info", "hello", "notifications", "notification"))
+
+
+def sender_tokens(email, subjects=()):
+  """Features for a sender: its domain and parent domains, local-part
+  tokens and the words of its sampled subjects.
+  """
+  local, _, domain = email.lower().rpartition("@")
+  parts = domain.split(".")
+  tokens = ["d:" + ".".join(parts[i:]) for i in range(max(1, len(parts) - 1))]
+  tokens += ["l:" + token for token in re.split(r"[^a-z0-9]+", local)
+             if len(token) > 1 and not token.isdigit() and token not in STOP_WORDS]
+  for subject in subjects:
+    tokens += ["s:" + word for word in re.findall(r"[^\W\d_]{3,}", subject.lower())
+               if word not in STOP_WORDS]
+  return tokens
+
+
+class TagSuggester:
+  """Multinomial naive Bayes over TF-IDF weighted sender tokens."""
+
+  def __init__(self, smoothing=SMOOTHING):
+    self.smoothing = smoothing
+    self.vocabulary = {}
+    self.labels = []
+
+  def fit(self, examples):
+    """Train on an iterable of (tokens, label) pairs."""
+    label_ids = {}
+    doc_labels = []
+    doc_tokens = []
+    for tokens, label in examples:
+      doc_labels.append(label_ids.setdefault(label, len(label_ids)))
+      doc_tokens.append([self.vocabulary.setdefault(token, len(self.vocabulary))
+                         for token in tokens])
+    self.labels = list(label_ids)
+    if not self.labels:
+      return self
+
+    lengths = np.fromiter((len(tokens) for tokens in doc_tokens), dtype=np.int64,
+                          count=len(doc_tokens))
+    token_ids = np.fromiter((t for tokens in doc_tokens for t in tokens),
+                            dtype=np.int64, count=int(lengths.sum()))
+    rows = np.repeat(np.asarray(doc_labels, dtype=np.int64), lengths)
+    doc_ids = np.repeat(np.arange(len(doc_tokens)), lengths)
+
+    num_labels, num_tokens = len(self.labels), len(self.vocabulary)
+    # Document frequency counts every token once per training sender
+    unique_pairs = np.unique(doc_ids * num_tokens + token_ids)
+    document_frequency = np.bincount(unique_pairs % num_tokens,
+                                     minlength=num_tokens)
+    self.idf = np.log((1 + len(doc_tokens)) / (1 + document_frequency)) + 1
+
+    counts = np.zeros((num_labels, num_tokens))
+    np.add.at(counts, (rows, token_ids), self.idf[token_ids])
+    smoothed = counts + self.smoothing
+    self.log_likelihood = np.log(smoothed / smoothed.sum(axis=1, keepdims=True))
+    priors = np.bincount(doc_labels, minlength=num_labels)
+    self.log_prior = np.log(priors / priors.sum())
+    return self
+
+  def predict(self, token_lists, k=TOP_K):
+    """Return, for every token list, up to k (label, probability) pairs."""
+    if not self.labels:
+      return [[] for _ in token_lists]
+    known = [[self.vocabulary[token] for token in tokens if token in self.vocabulary]
+             for tokens in token_lists]
+    lengths = np.fromiter((len(ids) for ids in known), dtype=np.int64,
+                          count=len(known))
+    token_ids = np.fromiter((t for ids in known for t in ids), dtype=np.int64,
+                            count=int(lengths.sum()))
+
+    scores = np.tile(self.log_prior, (len(known), 1))
+    nonempty = lengths > 0
+    if token_ids.size:
+      contributions = self.log_likelihood[:, token_ids].T * \
+          self.idf[token_ids, None]
+      offsets = np.concatenate(([0], np.cumsum(lengths[nonempty])[:-1]))
+      # Averaging over the sender's tokens tempers naive Bayes' overconfidence
+      scores[nonempty] += np.add.reduceat(contributions, offsets, axis=0) / \
+          lengths[nonempty, None]
+
+    scores -= scores.max(axis=1, keepdims=True)
+    probabilities = np.exp(scores)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    probabilities[~nonempty] = 0  # Nothing known about the sender
+
+    k = min(k, len(self.labels))
+    top = np.argsort(-probabilities, axis=1)[:, :k]
+    return [[(self.labels[j], float(probabilities[i, j])) for j in row
+             if probabilities[i, j] > 0]
+            for i, row in enumerate(top)]
+
+
+def iter_training_pairs(tagged_filename, filters_filename=None):
+  """Yield (sender, label) pairs from xmlupdate.txt and mailFilters.xml."""
+  try:
+    with open(tagged_filename, "r", encoding="utf-8") as f:
+      for line in f:
+        if ": " in line:
+          email, tags = line.strip().split(": ", 1)
+          for tag in tags.split(", "):
+            yield email, tag
+  except FileNotFoundError:
+    pass
+
+  if filters_filename:
+    try:
+      root = ET.parse(filters_filename).getroot()
+      for entry in root.iter("{http://www.w3.org/2005/Atom}entry"):
+        props = {prop.get("name"): prop.get("value")
+                 for prop in entry.iterfind("apps:property", sender_matcher.APPS_NS)}
+        if props.get("from") and props.get("label"):
+          for term in sender_matcher.split_criteria(props["from"]):
+            normalized = sender_matcher.normalize_term(term)
+            if normalized is not None:
+              kind, value = normalized
+              yield (value if kind == "exact" else "@" + value), props["label"]
+    except (ET.ParseError, FileNotFoundError):
+      pass
+
+
+def train(index_file, tagged_filename, filters_filename=None,
+          email_subjects=None):
+  """Build a TagSuggester from existing assignments, using the subjects the
+  sender index sampled for each tagged sender. email_subjects, when given,
+  is used instead of reading index_file.
+  """
+  pairs = list(iter_training_pairs(tagged_filename, filters_filename))
+  senders = {email.lower() for email, _ in pairs}
+  subjects = {}
+  if email_subjects is not None:
+    records = ({"email": email, "subjects": sampled}
+               for email, sampled in email_subjects.items())
+  else:
+    records = sender_index.iter_sender_index(index_file)
+  try:
+    for record in records:
+      if record["email"].lower() in senders:
+        subjects[record["email"].lower()] = record["subjects"]
+  except FileNotFoundError:
+    pass
+  return TagSuggester().fit(
+      (sender_tokens(email, subjects.get(email.lower(), ())), label)
+      for email, label in pairs)
+
+
+def annotate(suggester, records, chunk_size=SCORE_CHUNK):
+  """Yield the records with a "suggestions" list, scoring them in chunks."""
+  chunk = []
+  for record in records:
+    chunk.append(record)
+    if len(chunk) >= chunk_size:
+      yield from _annotate_chunk(suggester, chunk)
+      chunk = []
+  yield from _annotate_chunk(suggester, chunk)
+
+
+def _annotate_chunk(suggester, chunk):
+  if not chunk:
+    return
+  suggestions = suggester.predict(
+      [sender_tokens(record["email"], record.get("subjects") or ())
+       for record in chunk])
+  for record, ranked in zip(chunk, suggestions):
+    record["suggestions"] = ranked
+    yield record